@@ -8,7 +8,7 @@ import {
   Users,
 } from "lucide-react";
 import React from "react";
-import { API_URL, apiFetch } from "../../utils/fetchConfig";
+import { IMAGE_URL, apiFetch } from "../../utils/fetchConfig";
 
 const statsConfig = [
   {
@@ -143,7 +143,7 @@ export default function AdminDashboard() {
                 key={item.uuid}
                 className="flex items-center gap-4 p-3 rounded-lg hover:bg-neutral-50 transition-colors">
                 <img
-                  src={`${API_URL}${item.image_path}`}
+                  src={`${IMAGE_URL}${item.image_path}`}
                   alt={item.name}
                   className="w-16 h-16 rounded-lg object-cover"
                 />
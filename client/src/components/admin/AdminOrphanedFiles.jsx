@@ -14,23 +14,37 @@ const { OptimizedImage } = ImageLoader;
 
 const AdminOrphanedFiles = () => {
   const [files, setFiles] = React.useState([]);
+  const [total, setTotal] = React.useState(0);
+  const [page, setPage] = React.useState(1);
+  const [hasNext, setHasNext] = React.useState(false);
+  const [scan, setScan] = React.useState(null);
   const [loading, setLoading] = React.useState(true);
   const [error, setError] = React.useState(null);
   const [deletingFiles, setDeletingFiles] = React.useState(new Set());
+  const [deletingAll, setDeletingAll] = React.useState(false);
   const isDev = API_URL.startsWith("http://");
 
-  const fetchFiles = React.useCallback(async () => {
+  const fetchFiles = React.useCallback(async (pageToLoad = 1) => {
     try {
-      const response = await fetch(`${API_URL}/api/admin/orphaned-files`, {
-        credentials: "include",
-      });
+      const response = await fetch(
+        `${API_URL}/api/admin/orphaned-files?page=${pageToLoad}`,
+        {
+          credentials: "include",
+        },
+      );
 
       if (!response.ok) {
         throw new Error("Failed to fetch orphaned files");
       }
 
       const data = await response.json();
-      setFiles(data);
+      setFiles((prev) =>
+        pageToLoad === 1 ? data.files : [...prev, ...data.files],
+      );
+      setTotal(data.total);
+      setHasNext(data.has_next);
+      setScan(data.scan);
+      setPage(pageToLoad);
       setError(null);
     } catch (error) {
       console.error("Error fetching orphaned files:", error);
@@ -44,6 +58,39 @@ const AdminOrphanedFiles = () => {
     fetchFiles();
   }, [fetchFiles]);
 
+  const handleDeleteAll = async () => {
+    if (
+      !confirm(
+        `Are you sure you want to delete all ${total} orphaned files? This action cannot be undone.`,
+      )
+    )
+      return;
+
+    try {
+      setDeletingAll(true);
+
+      const response = await fetch(`${API_URL}/api/admin/orphaned-files`, {
+        method: "DELETE",
+        credentials: "include",
+      });
+
+      if (!response.ok) {
+        throw new Error("Failed to delete files");
+      }
+
+      const data = await response.json();
+      if (data.failed.length > 0) {
+        alert(`${data.failed.length} files could not be deleted.`);
+      }
+      await fetchFiles();
+    } catch (error) {
+      console.error("Error deleting files:", error);
+      alert("Failed to delete files. Please try again.");
+    } finally {
+      setDeletingAll(false);
+    }
+  };
+
   const handleDelete = async (key) => {
     if (
       !confirm(
@@ -68,6 +115,7 @@ const AdminOrphanedFiles = () => {
       }
 
       setFiles((prev) => prev.filter((file) => file.key !== key));
+      setTotal((prev) => prev - 1);
     } catch (error) {
       console.error("Error deleting file:", error);
       alert("Failed to delete file. Please try again.");
@@ -155,7 +203,9 @@ const AdminOrphanedFiles = () => {
                 No Orphaned Files Found
               </h3>
               <p className="text-emerald-600 mt-1">
-                All files in S3 have corresponding database entries.
+                {scan
+                  ? "All files in S3 have corresponding database entries."
+                  : "The first scan hasn't finished yet, check back shortly."}
               </p>
             </div>
           </div>
@@ -171,9 +221,29 @@ const AdminOrphanedFiles = () => {
                 Files that exist in S3 but lack corresponding database entries.
               </p>
             </div>
-            <div className="text-sm text-neutral-500">
-              {files.length} orphaned {files.length === 1 ? "file" : "files"}{" "}
-              found
+            <div className="flex items-center gap-4">
+              <div className="text-sm text-neutral-500">
+                {total} orphaned {total === 1 ? "file" : "files"} found{" "}
+                {formatDistance(new Date(scan.finished_at), new Date(), {
+                  addSuffix: true,
+                })}
+              </div>
+              <button
+                onClick={handleDeleteAll}
+                disabled={deletingAll}
+                className="flex items-center gap-2 px-3 py-1.5 bg-red-600 text-white rounded-lg hover:bg-red-700 transition-colors disabled:opacity-50">
+                {deletingAll ? (
+                  <>
+                    <Loader2 size={14} className="animate-spin" />
+                    <span>Deleting...</span>
+                  </>
+                ) : (
+                  <>
+                    <Trash2 size={14} />
+                    <span>Delete all</span>
+                  </>
+                )}
+              </button>
             </div>
           </div>
 
@@ -232,6 +302,16 @@ const AdminOrphanedFiles = () => {
               </div>
             ))}
           </div>
+
+          {hasNext && (
+            <div className="flex justify-center">
+              <button
+                onClick={() => fetchFiles(page + 1)}
+                className="px-4 py-2 bg-neutral-100 text-neutral-700 rounded-lg hover:bg-neutral-200 transition-colors">
+                Load more
+              </button>
+            </div>
+          )}
         </>
       )}
     </div>
@@ -37,11 +37,10 @@ export default function MarketplaceItem({ item, onUpdate, canvas, isOwn }) {
   const handleUse = () => {
     if (!canvas) return;
 
-    // use preview quality for initial quick load
+    // use preview quality for initial quick load, at the original size so
+    // it's the rendition the server pre-renders
     const previewUrl = getOptimizedImageUrl(item.image_path, {
-      width: item.width,
       quality: 50,
-      originalWidth: item.width,
     });
 
     const img = new Image();
@@ -1,4 +1,8 @@
-import { useInfiniteQuery, useQueryClient } from "@tanstack/react-query";
+import {
+  keepPreviousData,
+  useInfiniteQuery,
+  useQueryClient,
+} from "@tanstack/react-query";
 import { LogIn, Search } from "lucide-react";
 import {
   forwardRef,
@@ -18,9 +22,16 @@ const ITEMS_PER_PAGE = 9;
 const MarketplaceList = forwardRef(({ canvas }, ref) => {
   const { user } = useAuth();
   const [searchTerm, setSearchTerm] = useState("");
+  const [searchQuery, setSearchQuery] = useState("");
   const scrollContainerRef = useRef(null);
   const queryClient = useQueryClient();
 
+  // search on the server once typing pauses
+  useEffect(() => {
+    const timeout = setTimeout(() => setSearchQuery(searchTerm.trim()), 300);
+    return () => clearTimeout(timeout);
+  }, [searchTerm]);
+
   // fetch marketplace items with infinite scroll
   const {
     data,
@@ -30,21 +41,19 @@ const MarketplaceList = forwardRef(({ canvas }, ref) => {
     isLoading,
     refetch,
   } = useInfiniteQuery({
-    queryKey: ["marketplace-items"],
-    queryFn: async ({ pageParam = 1 }) => {
-      const response = await fetch(
-        `${API_URL}/api/marketplace/items?page=${pageParam}&per_page=${ITEMS_PER_PAGE}`,
-        { credentials: "include" },
-      );
+    queryKey: ["marketplace-items", searchQuery],
+    queryFn: async ({ pageParam = "" }) => {
+      const url = searchQuery
+        ? `${API_URL}/api/marketplace/search?q=${encodeURIComponent(searchQuery)}&cursor=${encodeURIComponent(pageParam)}&per_page=${ITEMS_PER_PAGE}`
+        : `${API_URL}/api/marketplace/items?cursor=${encodeURIComponent(pageParam)}&per_page=${ITEMS_PER_PAGE}`;
+      const response = await fetch(url, { credentials: "include" });
       if (!response.ok) throw new Error("Failed to fetch items");
       const data = await response.json();
-      return data.items || [];
+      return { items: data.items || [], nextCursor: data.next_cursor };
     },
-    getNextPageParam: (lastPage, pages) => {
-      if (!lastPage || lastPage.length < ITEMS_PER_PAGE) return undefined;
-      return pages.length + 1;
-    },
-    initialPageParam: 1,
+    getNextPageParam: (lastPage) => lastPage?.nextCursor || undefined,
+    initialPageParam: "",
+    placeholderData: keepPreviousData, // keep the list up while a search loads
     staleTime: 5 * 60 * 1000, // consider data fresh for 5 minutes
     gcTime: 30 * 60 * 1000, // keep cache for 30 minutes
   });
@@ -77,22 +86,10 @@ const MarketplaceList = forwardRef(({ canvas }, ref) => {
     }
   }, [handleScroll]);
 
-  const allItems = (data?.pages || []).flatMap((page) => page || []);
-  const filteredItems = allItems.filter((item) => {
-    if (!item || !searchTerm) return true;
-    const searchTerms = searchTerm
-      .toLowerCase()
-      .split(",")
-      .map((term) => term.trim());
-    return searchTerms.some(
-      (term) =>
-        (item.name && item.name.toLowerCase().includes(term)) ||
-        (item.categories &&
-          item.categories.some((category) =>
-            category.toLowerCase().includes(term),
-          )),
-    );
-  });
+  // search results are already filtered by the server
+  const filteredItems = (data?.pages || []).flatMap(
+    (page) => page?.items || [],
+  );
 
   const myItems = user
     ? filteredItems.filter((item) => item?.author?.uuid === user.uuid)
@@ -127,19 +124,23 @@ const MarketplaceList = forwardRef(({ canvas }, ref) => {
 
       if (response.ok) {
         // update the item in the cache
-        queryClient.setQueryData(["marketplace-items"], (oldData) => {
-          if (!oldData?.pages) return oldData;
-          return {
-            ...oldData,
-            pages: oldData.pages.map((page) =>
-              (page || []).map((i) =>
-                i?.uuid === item.uuid
-                  ? { ...i, is_bookmarked: !i.is_bookmarked }
-                  : i,
-              ),
-            ),
-          };
-        });
+        queryClient.setQueriesData(
+          { queryKey: ["marketplace-items"] },
+          (oldData) => {
+            if (!oldData?.pages) return oldData;
+            return {
+              ...oldData,
+              pages: oldData.pages.map((page) => ({
+                ...page,
+                items: (page?.items || []).map((i) =>
+                  i?.uuid === item.uuid
+                    ? { ...i, is_bookmarked: !i.is_bookmarked }
+                    : i,
+                ),
+              })),
+            };
+          },
+        );
       }
     } catch (error) {
       console.error("Error toggling bookmark:", error);
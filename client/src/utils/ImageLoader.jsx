@@ -1,4 +1,4 @@
-import { API_URL } from "./fetchConfig";
+import { IMAGE_URL } from "./fetchConfig";
 
 // quality presets
 const THUMBNAIL_QUALITY = 30;
@@ -27,7 +27,7 @@ function getOptimizedImageUrl(path, options = {}) {
 
   if (height) params.set("h", height);
 
-  const baseUrl = `${API_URL}${path}`;
+  const baseUrl = `${IMAGE_URL}${path}`;
   const queryString = params.toString();
   return queryString ? `${baseUrl}?${queryString}` : baseUrl;
 }
@@ -1,5 +1,10 @@
 export const API_URL = import.meta.env.VITE_API_URL;
 
+// images can come from another origin than the API, set VITE_IMAGE_URL=""
+// to load them through the frontend's nginx, which the backend's
+// CACHE_ACCEL_REDIRECT needs to serve cached renditions
+export const IMAGE_URL = import.meta.env.VITE_IMAGE_URL ?? API_URL;
+
 export const fetchConfig = {
   credentials: "include",
   headers: {
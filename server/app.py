@@ -1,11 +1,14 @@
 from os import environ
 
+from bookmarks import bookmarks_cli
 from cleanup import CleanupScheduler
 from config import Config
 from extensions import db, limiter, login_manager
 from flask import Flask, redirect
 from flask_cors import CORS
 from flask_talisman import Talisman
+from renditions import renditions_cli
+from schema import upgrade_schema
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 if Config.ENV == "dev":
@@ -13,7 +16,6 @@ if Config.ENV == "dev":
 
 app = Flask(__name__)
 app.config.from_object(Config)
-cleanup = CleanupScheduler(app)
 
 if Config.ENV != "dev":
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -33,6 +35,8 @@ app.register_blueprint(marketplace_bp)
 app.register_blueprint(admin_bp)
 app.register_blueprint(bgremove_bp)
 app.register_blueprint(uploads_bp)
+app.cli.add_command(renditions_cli)
+app.cli.add_command(bookmarks_cli)
 
 db.init_app(app)
 login_manager.init_app(app)
@@ -57,7 +61,10 @@ def root():
 
 
 with app.app_context():
-    db.create_all()
+    upgrade_schema()
+
+# started once the tables exist, the first heartbeat runs right away
+cleanup = CleanupScheduler(app)
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,153 @@
+"""Compare the rendition resize path against the previous full-decode path.
+
+Run from the server directory:
+
+    python -m benchmarks.resize [image ...]
+
+Without arguments a set of synthetic images shaped like typical marketplace
+uploads is generated. Every (path, image, size) combination runs in a fresh
+process, and peak RSS is read from VmHWM after resetting it, so earlier runs
+don't pollute the numbers. Peak RSS needs Linux.
+"""
+
+import io
+import multiprocessing
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+RUNS = 5
+TARGETS = [(200, 30), (800, 50)]  # (width, quality) of thumbnail and preview
+
+
+def legacy_optimize_image(image_data, width=None, height=None, quality=50):
+    img = Image.open(io.BytesIO(image_data))
+
+    if img.mode not in ("RGBA", "RGB"):
+        img = img.convert("RGB")
+
+    if width or height:
+        original_width, original_height = img.size
+        if width and width > original_width:
+            width = original_width
+        if height and height > original_height:
+            height = original_height
+
+        if width and height:
+            new_size = (int(width), int(height))
+        elif width:
+            ratio = float(width) / original_width
+            new_size = (int(width), int(original_height * ratio))
+        else:
+            ratio = float(height) / original_height
+            new_size = (int(original_width * ratio), int(height))
+
+        if new_size != img.size:
+            img = img.resize(new_size, Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    img.save(output, format="WEBP", quality=quality, method=4)
+    output.seek(0)
+    return output
+
+
+def current_optimize_image(image_data, width=None, height=None, quality=50):
+    from routes.uploads import optimize_image
+
+    return optimize_image(image_data, width, height, quality, "webp")
+
+
+PATHS = {"legacy": legacy_optimize_image, "current": current_optimize_image}
+
+
+def synthetic_images():
+    photo = Image.effect_noise((4000, 3000), 40).convert("RGB")
+    photo = photo.filter(ImageFilter.GaussianBlur(3))
+    jpeg = io.BytesIO()
+    photo.save(jpeg, format="JPEG", quality=90)
+
+    sticker = Image.new("RGBA", (2048, 2048), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sticker)
+    draw.ellipse((200, 200, 1848, 1848), fill=(230, 80, 120, 255))
+    draw.rectangle((700, 700, 1348, 1348), fill=(40, 40, 200, 200))
+    png = io.BytesIO()
+    sticker.save(png, format="PNG")
+
+    palette = io.BytesIO()
+    sticker.resize((1200, 1200)).convert("P", palette=Image.Palette.ADAPTIVE).save(
+        palette, format="PNG", transparency=0
+    )
+
+    return {
+        "photo-4000x3000.jpg": jpeg.getvalue(),
+        "sticker-2048x2048.png": png.getvalue(),
+        "palette-1200x1200.png": palette.getvalue(),
+    }
+
+
+def reset_peak_rss():
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(path, image_data, width, quality, results):
+    optimize = PATHS[path]
+    if path == "current":
+        import routes.uploads  # noqa: F401, keep app imports out of the peak
+
+    optimize(image_data, width, None, quality)  # warm up codecs
+
+    reset_peak_rss()
+    baseline = peak_rss()
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        optimize(image_data, width, None, quality)
+        timings.append(time.perf_counter() - start)
+
+    results.put((statistics.median(timings), peak_rss() - baseline))
+
+
+def run(path, image_data, width, quality):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=measure, args=(path, image_data, width, quality, results)
+    )
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(paths):
+    if paths:
+        images = {}
+        for image_path in paths:
+            with open(image_path, "rb") as f:
+                images[image_path] = f.read()
+    else:
+        images = synthetic_images()
+
+    print(f"{'image':<26}{'width':>6}  {'path':<8}{'median ms':>10}{'peak KiB':>10}")
+    for name, image_data in images.items():
+        for width, quality in TARGETS:
+            for path in PATHS:
+                seconds, peak = run(path, image_data, width, quality)
+                print(
+                    f"{name:<26}{width:>6}  {path:<8}{seconds * 1000:>10.1f}{peak:>10}"
+                )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
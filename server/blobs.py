@@ -0,0 +1,53 @@
+import io
+
+from extensions import db
+from models import Blob
+from s3 import delete_file, upload_file
+from sqlalchemy.dialects.sqlite import insert
+
+
+def acquire_blob(content_hash, size):
+    """Take a reference on the blob of ``content_hash``, creating its row.
+
+    Call in the transaction that creates the referencing item. Returns the
+    blob, its object still has to be uploaded if ``stored`` is false.
+    """
+    statement = insert(Blob).values(sha256=content_hash, size=size, ref_count=1)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Blob.sha256],
+            set_={"ref_count": Blob.ref_count + 1},
+        )
+    )
+    return db.session.get(Blob, content_hash, populate_existing=True)
+
+
+def store_blob(blob, data, content_type):
+    upload_file(io.BytesIO(data), "marketplace", blob.sha256, content_type)
+    blob.stored = True
+    db.session.commit()
+
+
+def release_blob(content_hash):
+    """Drop a reference, deleting the object along with the last one.
+
+    Call before committing the removal of the referencing item. The object is
+    deleted while the decrement holds SQLite's write lock, so an upload of
+    the same content waits for the row to be gone and stores it again.
+    """
+    Blob.query.filter_by(sha256=content_hash).update(
+        {"ref_count": Blob.ref_count - 1}, synchronize_session=False
+    )
+    blob = db.session.get(Blob, content_hash, populate_existing=True)
+    if blob is not None and blob.ref_count <= 0:
+        # a failed delete leaves the object to the orphan scan
+        delete_file(f"marketplace/{content_hash}")
+        db.session.delete(blob)
+
+
+def release_item_image(item):
+    """Release the stored image of an item that is being deleted."""
+    if item.content_hash:
+        release_blob(item.content_hash)
+    else:
+        delete_file(item.image_path)
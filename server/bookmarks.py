@@ -0,0 +1,36 @@
+import click
+from cached_views import BOOKMARKS, bump_generation
+from extensions import db
+from flask.cli import AppGroup
+from models import Bookmark, MarketplaceItem
+
+bookmarks_cli = AppGroup("bookmarks", help="Maintain marketplace bookmark counts.")
+
+
+def change_bookmark_count(item_uuid, delta):
+    """Adjust an item's denormalized count, in the transaction of the bookmark."""
+    MarketplaceItem.query.filter_by(uuid=item_uuid).update(
+        {"bookmark_count": MarketplaceItem.bookmark_count + delta},
+        synchronize_session=False,
+    )
+
+
+def recount_bookmarks():
+    """Recompute every item's bookmark count, returns how many had drifted."""
+    actual = (
+        db.select(db.func.count(Bookmark.uuid))
+        .where(Bookmark.item_uuid == MarketplaceItem.uuid)
+        .scalar_subquery()
+    )
+    repaired = MarketplaceItem.query.filter(
+        MarketplaceItem.bookmark_count != actual
+    ).update({"bookmark_count": actual}, synchronize_session=False)
+    bump_generation(BOOKMARKS)
+    db.session.commit()
+    return repaired
+
+
+@bookmarks_cli.command("recount")
+def recount_command():
+    """Repair the bookmark counts of marketplace items."""
+    click.echo(f"{recount_bookmarks()} items repaired")
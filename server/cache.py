@@ -0,0 +1,494 @@
+import fcntl
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import NamedTuple, Optional, Tuple
+
+from config import Config
+
+SCHEMA_VERSION = 4
+
+# re-stamping the access time on every hit would turn each read into a write,
+# LRU order only needs to be roughly right
+ACCESS_RESOLUTION = 60
+EVICTION_BATCH = 64
+LOCK_POLL_INTERVAL = 0.05
+# nginx reads the files as its own user when it serves cache hits directly
+FILE_MODE = 0o644
+DIRECTORY_MODE = 0o755
+
+
+class CacheEntry(NamedTuple):
+    path: str
+    etag: str
+    last_modified: float
+    size: int
+    expires_at: float
+
+
+class MemoryEntry(NamedTuple):
+    data: bytes
+    etag: str
+    last_modified: Optional[float]
+    # copied from the disk entry so both copies go stale together
+    expires_at: Optional[float]
+    touched_at: float
+
+
+class RenditionCache:
+    """Sharded on-disk cache for image renditions.
+
+    Files live under ``<cache_dir>/<k[:2]>/<k[2:4]>/<k>``. A small SQLite index
+    next to them tracks size, last access time and expiry of every entry plus a
+    running byte total, so all gunicorn workers share one view of the cache and
+    eviction never has to walk the directory tree.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int, duration):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.duration = duration.total_seconds()
+        self.index_path = os.path.join(cache_dir, "index.db")
+        self._local = threading.local()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections must not cross a fork, gunicorn --preload imports us in
+        # the master before spawning workers
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.index_path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate(conn)
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                # the index is only a cache, so an incompatible one is dropped
+                # together with the files it tracked
+                for (key,) in self._select_all_keys(conn):
+                    self._unlink(key)
+                if version == 0:
+                    self._remove_legacy_files()
+                conn.execute("DROP TABLE IF EXISTS entries")
+                conn.execute("DROP TABLE IF EXISTS totals")
+                conn.execute("DROP TABLE IF EXISTS failures")
+                conn.execute("""
+                    CREATE TABLE entries (
+                        key TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        etag TEXT NOT NULL,
+                        last_modified REAL NOT NULL,
+                        accessed_at REAL NOT NULL,
+                        expires_at REAL NOT NULL
+                    )
+                    """)
+                conn.execute(
+                    "CREATE INDEX entries_accessed_at ON entries (accessed_at)"
+                )
+                conn.execute("CREATE INDEX entries_expires_at ON entries (expires_at)")
+                conn.execute("""
+                    CREATE TABLE totals (
+                        id INTEGER PRIMARY KEY CHECK (id = 0),
+                        bytes INTEGER NOT NULL
+                    )
+                    """)
+                conn.execute("INSERT INTO totals (id, bytes) VALUES (0, 0)")
+                conn.execute("""
+                    CREATE TABLE failures (
+                        source TEXT PRIMARY KEY,
+                        reason TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    )
+                    """)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _select_all_keys(self, conn: sqlite3.Connection):
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries'"
+        ).fetchone()
+        if not exists:
+            return []
+        return conn.execute("SELECT key FROM entries").fetchall()
+
+    def _remove_legacy_files(self):
+        # older releases kept every rendition directly in the cache dir
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.startswith("index.db"):
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+    def relative_path(self, key: str) -> str:
+        return f"{key[:2]}/{key[2:4]}/{key}"
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, self.relative_path(key))
+
+    def _make_shard(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        # the mode passed to makedirs is masked by the umask, set it explicitly
+        # on the cache directory and both shard levels
+        while True:
+            os.chmod(directory, DIRECTORY_MODE)
+            if os.path.samefile(directory, self.cache_dir):
+                break
+            directory = os.path.dirname(directory)
+
+    def _unlink(self, key: str):
+        try:
+            os.unlink(self.path_for(key))
+        except OSError:
+            pass
+
+    def _remove(self, conn: sqlite3.Connection, key: str, size: int):
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        conn.execute("UPDATE totals SET bytes = bytes - ? WHERE id = 0", (size,))
+        self._unlink(key)
+
+    def get(
+        self, key: str, count: bool = True, count_miss: bool = True
+    ) -> Optional[CacheEntry]:
+        """Return the path and ETag of a fresh cached rendition, or None.
+
+        Pass ``count=False`` for lookups that shouldn't show up in the hit and
+        miss stats, and ``count_miss=False`` when a miss is looked up again
+        and the second lookup decides whether it counts as a hit or a miss.
+        """
+        conn = self._connect()
+        row = conn.execute(
+            """
+            SELECT size, etag, last_modified, accessed_at, expires_at
+            FROM entries WHERE key = ?
+            """,
+            (key,),
+        ).fetchone()
+        if row is None:
+            if count and count_miss:
+                self.stats["misses"] += 1
+            return None
+
+        size, etag, last_modified, accessed_at, expires_at = row
+        now = time.time()
+        path = self.path_for(key)
+
+        if expires_at <= now or not os.path.exists(path):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # another worker may have replaced the entry in the meantime
+                if conn.execute(
+                    "SELECT 1 FROM entries WHERE key = ? AND expires_at = ?",
+                    (key, expires_at),
+                ).fetchone():
+                    self._remove(conn, key, size)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if count and count_miss:
+                self.stats["misses"] += 1
+            return None
+
+        if now - accessed_at > ACCESS_RESOLUTION:
+            conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        if count:
+            self.stats["hits"] += 1
+        return CacheEntry(path, etag, last_modified, size, expires_at)
+
+    def touch(self, key: str):
+        """Record an access to ``key`` that was served from somewhere else."""
+        now = time.time()
+        self._connect().execute(
+            "UPDATE entries SET accessed_at = ? WHERE key = ? AND accessed_at < ?",
+            (now, key, now - ACCESS_RESOLUTION),
+        )
+
+    def validators(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return (etag, last_modified) of a fresh entry from the index alone.
+
+        Used to answer conditional requests without opening the file.
+        """
+        return (
+            self._connect()
+            .execute(
+                """
+                SELECT etag, last_modified FROM entries
+                WHERE key = ? AND expires_at > ?
+                """,
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+
+    def sizes(self, keys) -> dict:
+        """Map each cached key to its size without counting it as an access."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        placeholders = ", ".join("?" for _ in keys)
+        rows = self._connect().execute(
+            f"SELECT key, size FROM entries WHERE key IN ({placeholders})"
+            " AND expires_at > ?",
+            (*keys, time.time()),
+        )
+        return dict(rows.fetchall())
+
+    def put(self, key: str, data: bytes, etag: str, last_modified: float) -> CacheEntry:
+        """Store a rendition and evict expired or least recently used entries.
+
+        The file's mtime is set to ``last_modified`` of the source, so anything
+        serving the file directly reports the source's age.
+        """
+        conn = self._connect()
+        path = self.path_for(key)
+        directory = os.path.dirname(path)
+        self._make_shard(directory)
+
+        # write to a temp file and rename so readers never see partial files,
+        # mkstemp creates it readable by its owner only
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.utime(tmp_path, (time.time(), last_modified))
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        now = time.time()
+        expires_at = now + self.duration
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            previous_size = row[0] if row else 0
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO entries
+                    (key, size, etag, last_modified, accessed_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (key, len(data), etag, last_modified, now, expires_at),
+            )
+            conn.execute(
+                "UPDATE totals SET bytes = bytes + ? WHERE id = 0",
+                (len(data) - previous_size,),
+            )
+            self._evict(conn, now, keep=key)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return CacheEntry(path, etag, last_modified, len(data), expires_at)
+
+    def _evict(self, conn: sqlite3.Connection, now: float, keep: str):
+        expired = conn.execute(
+            "SELECT key, size FROM entries WHERE expires_at <= ? LIMIT ?",
+            (now, EVICTION_BATCH),
+        ).fetchall()
+        for key, size in expired:
+            self._remove(conn, key, size)
+            self.stats["evictions"] += 1
+
+        total = self.total_size(conn)
+        while total > self.max_size:
+            oldest = conn.execute(
+                "SELECT key, size FROM entries WHERE key != ? ORDER BY accessed_at LIMIT ?",
+                (keep, EVICTION_BATCH),
+            ).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if total <= self.max_size:
+                    break
+                self._remove(conn, key, size)
+                self.stats["evictions"] += 1
+                total -= size
+
+    def failure(self, source: str) -> Optional[str]:
+        """Return why ``source`` recently failed to render, if it did."""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT reason FROM failures WHERE source = ? AND expires_at > ?",
+                (source, time.time()),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def record_failure(self, source: str, reason: str, ttl: float):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO failures (source, reason, expires_at) VALUES (?, ?, ?)",
+            (source, reason, now + ttl),
+        )
+        # keep the table from growing with keys nobody asks for again
+        conn.execute("DELETE FROM failures WHERE expires_at <= ?", (now,))
+
+    def clear_failure(self, source: str):
+        self._connect().execute("DELETE FROM failures WHERE source = ?", (source,))
+
+    @contextmanager
+    def single_flight(self, key: str, timeout: float):
+        """Let one process at a time produce ``key``.
+
+        Yields True once the producer lock is held. Waiters block until the
+        current producer is done, at which point the rendition is usually in
+        the cache already, or yield False after ``timeout`` seconds so the
+        caller can fall back to rendering on its own.
+        """
+        # lock files are striped by key prefix so they never need unlinking,
+        # which would race with waiters holding the old inode open
+        lock_dir = os.path.join(self.cache_dir, "locks")
+        os.makedirs(lock_dir, exist_ok=True)
+        fd = os.open(os.path.join(lock_dir, key[:3]), os.O_RDWR | os.O_CREAT, 0o644)
+        acquired = False
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    acquired = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        break
+                    time.sleep(LOCK_POLL_INTERVAL)
+            yield acquired
+        finally:
+            if acquired:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def total_size(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        conn = conn or self._connect()
+        return conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "bytes": self.total_size(),
+            "max_bytes": self.max_size,
+        }
+
+
+class MemoryCache:
+    """Byte-bounded LRU of encoded responses kept inside one worker process.
+
+    Sits in front of the disk cache for the small set of hot thumbnails, so
+    those are answered without touching the index or the filesystem, and
+    holds rendered JSON of the public marketplace endpoints.
+
+    Hits are passed on to ``backing`` at most every ``ACCESS_RESOLUTION``
+    seconds, so the disk LRU doesn't evict what is hottest in memory.
+    """
+
+    def __init__(self, max_size: int, backing: Optional[RenditionCache] = None):
+        self.max_size = max_size
+        self.backing = backing
+        # one large full-quality image shouldn't flush every thumbnail
+        self.max_item_size = max_size // 8
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: str) -> Optional[MemoryEntry]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            expired = (
+                entry is not None
+                and entry.expires_at is not None
+                and entry.expires_at <= now
+            )
+            if expired:
+                # expired on disk as well, the caller renders it again
+                del self._entries[key]
+                self._size -= len(entry.data)
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+
+            touch = (
+                self.backing is not None and now - entry.touched_at > ACCESS_RESOLUTION
+            )
+            if touch:
+                self._entries[key] = entry._replace(touched_at=now)
+
+        if touch:
+            self.backing.touch(key)
+        return entry
+
+    def put(
+        self,
+        key: str,
+        data: bytes,
+        etag: str,
+        last_modified: Optional[float],
+        expires_at: Optional[float] = None,
+    ):
+        if len(data) > self.max_item_size:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+
+            self._entries[key] = MemoryEntry(
+                data, etag, last_modified, expires_at, time.time()
+            )
+            self._size += len(data)
+
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.data)
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_size,
+            }
+
+
+rendition_cache = RenditionCache(
+    Config.CACHE_DIR, Config.MAX_CACHE_SIZE_BYTES, Config.CACHE_DURATION
+)
+memory_cache = MemoryCache(Config.MEMORY_CACHE_BYTES, backing=rendition_cache)
+response_cache = MemoryCache(Config.RESPONSE_CACHE_BYTES)
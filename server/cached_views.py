@@ -0,0 +1,86 @@
+import hashlib
+from functools import wraps
+
+from cache import response_cache
+from extensions import db
+from flask import Response, request
+from models import CacheGeneration
+from sqlalchemy.dialects.sqlite import insert
+
+MARKETPLACE = "marketplace"
+BOOKMARKS = "bookmarks"
+
+
+def get_generations(names):
+    rows = dict(
+        CacheGeneration.query.with_entities(
+            CacheGeneration.name, CacheGeneration.generation
+        ).filter(CacheGeneration.name.in_(names))
+    )
+    return [rows.get(name, 0) for name in names]
+
+
+def bump_generation(name=MARKETPLACE):
+    """Invalidate every cached response of ``name``, call before the commit.
+
+    The counter lives in the database, so the bump commits or rolls back with
+    the change it covers and every worker sees it on its next request.
+    """
+    statement = insert(CacheGeneration).values(name=name, generation=1)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[CacheGeneration.name],
+            set_={"generation": CacheGeneration.generation + 1},
+        )
+    )
+
+
+def cache_key(generations):
+    # the same arguments in any order share an entry
+    args = "&".join(
+        f"{key}={value}" for key, value in sorted(request.args.items(multi=True))
+    )
+    return f"{'.'.join(map(str, generations))}:{request.path}?{args}"
+
+
+def send_cached(data, etag):
+    response = Response(data, mimetype="application/json")
+    response.set_etag(etag)
+    # clients revalidate every time and get a 304 while nothing changed
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def cached_view(generations=lambda: (MARKETPLACE,)):
+    """Serve a public JSON view from the per-worker response cache.
+
+    ``generations`` returns the names of the generations the response of the
+    current request depends on. Entries are keyed on their values, so
+    bumping one makes every entry that depends on it unreachable at once and
+    they age out of the LRU. Only 200 responses are stored, a view marks a
+    response that depends on the viewer with ``response.cache_control.private``
+    to keep it out.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            key = cache_key(get_generations(generations()))
+            entry = response_cache.get(key)
+            if entry is not None:
+                return send_cached(entry.data, entry.etag)
+
+            response = view(*args, **kwargs)
+            if isinstance(response, tuple) or response.status_code != 200:
+                return response
+            if response.cache_control.private:
+                return response
+
+            data = response.get_data()
+            etag = hashlib.md5(data).hexdigest()
+            response_cache.put(key, data, etag, None)
+            return send_cached(data, etag)
+
+        return decorated_function
+
+    return decorator
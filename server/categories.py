@@ -0,0 +1,80 @@
+from extensions import db
+from models import CategoryCount, ItemCategory, MarketplaceItem
+from sqlalchemy.dialects.sqlite import insert
+
+
+def counted_categories(categories, is_private):
+    # facet counts only cover the public feed
+    return set() if is_private else set(categories or [])
+
+
+def adjust_counts(added, removed):
+    deltas = {category: 1 for category in added}
+    deltas.update({category: -1 for category in removed})
+    if not deltas:
+        return
+
+    statement = insert(CategoryCount).values(
+        [
+            {"category": category, "item_count": delta}
+            for category, delta in deltas.items()
+        ]
+    )
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[CategoryCount.category],
+            set_={
+                "item_count": CategoryCount.item_count + statement.excluded.item_count
+            },
+        )
+    )
+    CategoryCount.query.filter(CategoryCount.item_count <= 0).delete(
+        synchronize_session=False
+    )
+
+
+def sync_item_categories(item, previous_categories=None, previously_private=True):
+    """Bring an item's category rows and the facet counts in line with the item.
+
+    Call after changing ``item.categories`` or ``item.is_private``, passing the
+    values from before the change, in the same transaction as the change.
+    """
+    previous = set(previous_categories or [])
+    current = set(item.categories or [])
+
+    removed = previous - current
+    if removed:
+        ItemCategory.query.filter(
+            ItemCategory.item_uuid == item.uuid, ItemCategory.category.in_(removed)
+        ).delete(synchronize_session=False)
+    for category in current - previous:
+        db.session.add(ItemCategory(item_uuid=item.uuid, category=category))
+
+    before = counted_categories(previous, previously_private)
+    after = counted_categories(current, item.is_private)
+    adjust_counts(after - before, before - after)
+
+
+def remove_item_categories(item):
+    ItemCategory.query.filter_by(item_uuid=item.uuid).delete(synchronize_session=False)
+    adjust_counts(set(), counted_categories(item.categories, item.is_private))
+
+
+def rebuild_categories():
+    """Rebuild the category rows and counts from the items' JSON categories."""
+    ItemCategory.query.delete()
+    CategoryCount.query.delete()
+
+    counts = {}
+    items = MarketplaceItem.query.with_entities(
+        MarketplaceItem.uuid, MarketplaceItem.categories, MarketplaceItem.is_private
+    )
+    for item_uuid, categories, is_private in items:
+        for category in set(categories or []):
+            db.session.add(ItemCategory(item_uuid=item_uuid, category=category))
+        for category in counted_categories(categories, is_private):
+            counts[category] = counts.get(category, 0) + 1
+
+    for category, item_count in counts.items():
+        db.session.add(CategoryCount(category=category, item_count=item_count))
+    db.session.commit()
@@ -1,8 +1,20 @@
-from datetime import datetime, timedelta
+import atexit
+import os
+import socket
+import time
+from datetime import datetime
+from functools import partial
 
 from config import Config
+from extensions import db
 from flask_apscheduler import APScheduler
-from s3 import get_s3_client
+from models import JobRun, SchedulerLease, TemporaryFile
+from orphans import reconcile_orphans
+from renditions import render_pending_renditions
+from s3 import delete_keys, iter_objects
+from sqlalchemy.exc import IntegrityError
+
+LEASE_NAME = "scheduler"
 
 
 class CleanupScheduler:
@@ -17,12 +29,145 @@ class CleanupScheduler:
         self.scheduler.init_app(app)
         self.scheduler.start()
 
+        # every process with a scheduler competes for the lease, only the
+        # holder runs the jobs below
         self.scheduler.add_job(
-            id="cleanup_nobg",
-            func=self.cleanup_expired_files,
+            id="scheduler_heartbeat",
+            func=self.heartbeat,
             trigger="interval",
-            minutes=10,
+            seconds=Config.SCHEDULER_HEARTBEAT_INTERVAL,
+            next_run_time=datetime.now(),
+        )
+        self.add_leader_job("cleanup_nobg", self.cleanup_expired_files, minutes=1)
+        self.add_leader_job("sweep_nobg", self.sweep_untracked_files, days=1)
+        self.add_leader_job("reconcile_orphans", reconcile_orphans, minutes=1)
+        self.add_leader_job("render_renditions", self.render_renditions, seconds=5)
+
+        # hand the lease over on a clean shutdown instead of making the next
+        # process wait for it to expire
+        atexit.register(self.release_lease)
+
+    def add_leader_job(self, job_id, func, **interval):
+        self.scheduler.add_job(
+            id=job_id,
+            func=partial(self.run_job, job_id, func),
+            trigger="interval",
+            **interval,
+        )
+
+    @property
+    def holder(self):
+        # the pid is read every time, workers forked after import are
+        # different holders than the process that created the scheduler
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def heartbeat(self):
+        with self.app.app_context():
+            try:
+                if self.acquire_lease():
+                    JobRun.query.filter(
+                        JobRun.started_at < datetime.utcnow() - Config.JOB_RUN_RETENTION
+                    ).delete(synchronize_session=False)
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Scheduler heartbeat error: {str(e)}")
+
+    def acquire_lease(self):
+        """Take or renew the scheduler lease, returns whether this process holds it.
+
+        A lease that hasn't been renewed within SCHEDULER_LEASE_TTL belongs to
+        a process that died and is taken over.
+        """
+        holder = self.holder
+        now = datetime.utcnow()
+        expires_at = now + Config.SCHEDULER_LEASE_TTL
+
+        renewed = SchedulerLease.query.filter(
+            SchedulerLease.name == LEASE_NAME,
+            (SchedulerLease.holder == holder) | (SchedulerLease.expires_at < now),
+        ).update(
+            {
+                "acquired_at": db.case(
+                    (SchedulerLease.holder == holder, SchedulerLease.acquired_at),
+                    else_=now,
+                ),
+                "holder": holder,
+                "expires_at": expires_at,
+            },
+            synchronize_session=False,
         )
+        if renewed:
+            db.session.commit()
+            return True
+
+        try:
+            db.session.add(
+                SchedulerLease(
+                    name=LEASE_NAME,
+                    holder=holder,
+                    acquired_at=now,
+                    expires_at=expires_at,
+                )
+            )
+            db.session.commit()
+            self.app.logger.info(f"Scheduler lease acquired by {holder}")
+            return True
+        except IntegrityError:
+            # another process holds a live lease
+            db.session.rollback()
+            return False
+
+    def is_leader(self):
+        lease = db.session.get(SchedulerLease, LEASE_NAME)
+        return (
+            lease is not None
+            and lease.holder == self.holder
+            and lease.expires_at > datetime.utcnow()
+        )
+
+    def release_lease(self):
+        with self.app.app_context():
+            SchedulerLease.query.filter_by(name=LEASE_NAME, holder=self.holder).delete()
+            db.session.commit()
+
+    def run_job(self, job_id, func):
+        """Run a job if this process is the leader and record how it went.
+
+        Jobs return a detail string, or None when there was nothing to do.
+        Those runs aren't recorded, the frequent jobs would otherwise bury
+        the runs that did something under idle ones.
+        """
+        with self.app.app_context():
+            if not self.is_leader():
+                return
+
+            run = JobRun(
+                job_id=job_id, holder=self.holder, started_at=datetime.utcnow()
+            )
+            start = time.perf_counter()
+            try:
+                run.detail = func()
+                run.status = "success"
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Scheduled job {job_id} failed: {str(e)}")
+                run.status = "error"
+                run.detail = str(e)
+            run.duration_ms = int((time.perf_counter() - start) * 1000)
+            if run.status == "success" and run.detail is None:
+                return
+
+            try:
+                db.session.add(run)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Failed to record {job_id} run: {str(e)}")
+
+    def render_renditions(self):
+        rendered = render_pending_renditions(self.app)
+        return f"{rendered} jobs processed" if rendered else None
 
     def parse_timestamp(self, key):
         try:
@@ -31,50 +176,85 @@ class CleanupScheduler:
         except (IndexError, ValueError):
             return None
 
+    def expired_keys(self, current_time):
+        for obj in iter_objects("nobg/"):
+            key = obj["Key"]
+            filename = key.split("/")[-1]  # get just the filename part
+
+            timestamp = self.parse_timestamp(filename)
+            if timestamp is None:
+                continue
+
+            file_time = datetime.fromtimestamp(timestamp)
+
+            if current_time - file_time > Config.TEMPORARY_FILE_TTL:
+                yield key
+
+    def log_cleanup_progress(self, summary):
+        self.app.logger.info(
+            f"Cleanup progress: {summary.deleted} deleted, "
+            f"{len(summary.failed)} failed"
+        )
+
     def cleanup_expired_files(self):
-        with self.app.app_context():
-            try:
-                s3 = get_s3_client()
-                bucket = Config.S3_BUCKET
-                current_time = datetime.now()
-                cleaned_count = 0
-
-                try:
-                    response = s3.list_objects_v2(Bucket=bucket, Prefix="nobg/")
-                except Exception as e:
-                    self.app.logger.error(f"Failed to list S3 objects: {str(e)}")
-                    return
-
-                if "Contents" not in response:
-                    return
-
-                objects_to_delete = []
-                for obj in response["Contents"]:
-                    key = obj["Key"]
-                    filename = key.split("/")[-1]  # get just the filename part
-
-                    timestamp = self.parse_timestamp(filename)
-                    if timestamp is None:
-                        continue
-
-                    file_time = datetime.fromtimestamp(timestamp)
-
-                    if current_time - file_time > timedelta(minutes=10):
-                        objects_to_delete.append({"Key": key})
-                        cleaned_count += 1
-
-                if objects_to_delete:
-                    try:
-                        s3.delete_objects(
-                            Bucket=bucket, Delete={"Objects": objects_to_delete}
-                        )
-                        self.app.logger.info(
-                            f"Cleaned up {cleaned_count} expired files from S3"
-                        )
-                    except Exception as e:
-                        self.app.logger.error(
-                            f"Failed to delete expired files from S3: {str(e)}"
-                        )
+        """Delete the temporary files that are due, found through their index rows."""
+        now = datetime.utcnow()
+        deleted = 0
 
-            except Exception as e:
-                self.app.logger.error(f"S3 cleanup error: {str(e)}")
+        while True:
+            keys = [
+                key
+                for (key,) in TemporaryFile.query.filter(
+                    TemporaryFile.expires_at <= now
+                )
+                .with_entities(TemporaryFile.key)
+                .order_by(TemporaryFile.expires_at)
+                .limit(Config.TEMPORARY_FILE_BATCH_SIZE)
+            ]
+            if not keys:
+                break
+
+            summary = delete_keys(keys)
+            failed = {error["Key"] for error in summary.failed}
+
+            # rows of keys S3 refused stay due and are retried next run
+            TemporaryFile.query.filter(
+                TemporaryFile.key.in_([key for key in keys if key not in failed])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += summary.deleted
+
+            if failed:
+                raise Exception(
+                    f"Failed to delete {len(failed)} expired files "
+                    f"from S3: {summary.failed[0]['Message']}"
+                )
+
+        if not deleted:
+            return None
+
+        self.app.logger.info(f"Cleaned up {deleted} expired files from S3")
+        return f"{deleted} deleted"
+
+    def sweep_untracked_files(self):
+        """Catch expired files that never got an index row, by listing the prefix.
+
+        Uploads from before the index existed, or whose row failed to commit,
+        would otherwise stay in the bucket forever.
+        """
+        # the listing is walked page by page and deleted as it goes, so the
+        # whole prefix is never held in memory
+        summary = delete_keys(
+            self.expired_keys(datetime.now()),
+            on_progress=self.log_cleanup_progress,
+        )
+
+        if summary.deleted:
+            self.app.logger.info(f"Swept {summary.deleted} expired files from S3")
+        if summary.failed:
+            raise Exception(
+                f"Failed to delete {len(summary.failed)} expired files "
+                f"from S3: {summary.failed[0]['Message']}"
+            )
+
+        return f"{summary.deleted} deleted"
@@ -53,14 +53,80 @@ class Config:
     S3_ACCESS_KEY = getenv("S3_ACCESS_KEY")
     S3_SECRET_KEY = getenv("S3_SECRET_KEY")
     S3_BUCKET = getenv("S3_BUCKET")
+    # one client per worker process, size the pool to the worker's concurrency
+    S3_MAX_POOL_CONNECTIONS = int(getenv("S3_MAX_POOL_CONNECTIONS", 16))
+    S3_CONNECT_TIMEOUT = 5  # seconds
+    S3_READ_TIMEOUT = 30  # seconds
+    S3_MAX_ATTEMPTS = 3
+    S3_RETRY_MODE = getenv("S3_RETRY_MODE", "standard")
+    S3_MULTIPART_THRESHOLD = int(getenv("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY = 4
+    S3_LIST_PAGE_SIZE = 1000
+    S3_DELETE_BATCH_SIZE = 1000  # the most delete_objects accepts
+    S3_DELETE_CONCURRENCY = 4
 
     # Image Cache
     MAX_CACHE_SIZE_BYTES = 1000 * 1024 * 1024  # 1GB max cache size
     CACHE_DIR = getenv("CACHE_DIR", "cache")
     CACHE_DURATION = timedelta(days=7)
+    RESPONSE_CACHE_BYTES = 16 * 1024 * 1024  # per worker
+    MEMORY_CACHE_BYTES = int(  # per worker
+        getenv("MEMORY_CACHE_BYTES", 64 * 1024 * 1024)
+    )
+    # answer disk hits with X-Accel-Redirect so nginx serves CACHE_DIR itself,
+    # off by default, only enable when the client loads images through the
+    # nginx in client/nginx.conf (VITE_IMAGE_URL=""), anything else gets an
+    # empty response with an X-Accel-Redirect header nobody handles
+    CACHE_ACCEL_REDIRECT = getenv("CACHE_ACCEL_REDIRECT", "").lower() == "true"
+    CACHE_ACCEL_PREFIX = "/_cache/"
+    # how long a missing or broken source is remembered before S3 is asked again
+    NOT_FOUND_CACHE_TTL = timedelta(minutes=1)
+    UNDECODABLE_CACHE_TTL = timedelta(minutes=30)
+    SINGLE_FLIGHT_TIMEOUT = 10  # seconds to wait for another worker's render
     THUMBNAIL_QUALITY = 30
     PREVIEW_QUALITY = 50
     FULL_QUALITY = 90
+    # encoder quality per output format for each tier above, webp uses them as is
+    AVIF_THUMBNAIL_QUALITY = 25
+    AVIF_PREVIEW_QUALITY = 40
+    AVIF_FULL_QUALITY = 70
+    JPEG_THUMBNAIL_QUALITY = 40
+    JPEG_PREVIEW_QUALITY = 60
+    JPEG_FULL_QUALITY = 90
+
+    # Requested widths and heights are rounded up to one of these so clients
+    # can't create an unbounded number of renditions
+    RENDITION_SIZES = [64, 128, 200, 400, 800, 1200, 1600, 2048]
+
+    # Renditions rendered right after a marketplace upload, as (w, h, q) in the
+    # same shape the client requests them, widths are capped at the item's
+    # width like the client does
+    PRERENDER_RENDITIONS = [
+        (200, None, THUMBNAIL_QUALITY),
+        (800, None, PREVIEW_QUALITY),
+        (None, None, PREVIEW_QUALITY),
+        (None, None, FULL_QUALITY),
+    ]
+    PRERENDER_FORMATS = ["avif", "webp"]
+    PRERENDER_MAX_ATTEMPTS = 3
+
+    # Marketplace uploads are normalized into a master before they're stored,
+    # anything over INGEST_MAX_PIXELS is refused before it is decoded
+    INGEST_MAX_PIXELS = 4000 * 4000
+    INGEST_MAX_DIMENSION = RENDITION_SIZES[-1]
+    INGEST_QUALITY = FULL_QUALITY  # lossy masters, ones with alpha are lossless
+
+    # Scheduler
+    SCHEDULER_HEARTBEAT_INTERVAL = 20  # seconds
+    SCHEDULER_LEASE_TTL = timedelta(seconds=60)
+    JOB_RUN_RETENTION = timedelta(days=1)
+    TEMPORARY_FILE_TTL = timedelta(minutes=10)
+    TEMPORARY_FILE_BATCH_SIZE = 5000
+    ORPHAN_SCAN_INTERVAL = timedelta(hours=6)
+    ORPHAN_SCAN_BATCH_SIZE = 10000  # keys compared per run before checkpointing
+    # objects this young may belong to an item whose row isn't committed yet
+    ORPHAN_GRACE_PERIOD = timedelta(hours=1)
 
     # Twitter
     TWITTER_AUTH_TOKEN = getenv("TWITTER_AUTH_TOKEN")
@@ -0,0 +1,70 @@
+import io
+from typing import NamedTuple
+
+from config import Config
+from PIL import Image, ImageOps, UnidentifiedImageError
+from routes.uploads import RESIZE_REDUCING_GAP, has_alpha
+
+MASTER_FORMAT = "webp"
+MASTER_MIMETYPE = "image/webp"
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+class IngestedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    format: str
+    content_type: str
+
+
+def ingest_image(stream) -> IngestedImage:
+    """Normalize an uploaded image into the master that gets stored.
+
+    The dimensions are checked from the header before any pixels are
+    decoded. The master is rotated upright, capped at INGEST_MAX_DIMENSION,
+    stripped of EXIF and other metadata and encoded as WebP, lossless when
+    it has an alpha channel, so every rendition starts from a small source.
+    """
+    try:
+        img = Image.open(stream)
+    except Image.DecompressionBombError:
+        raise InvalidImageError("Image dimensions are too large")
+    except (UnidentifiedImageError, OSError):
+        raise InvalidImageError("Invalid image file")
+
+    if img.width * img.height > Config.INGEST_MAX_PIXELS:
+        raise InvalidImageError("Image dimensions are too large")
+
+    max_size = (Config.INGEST_MAX_DIMENSION, Config.INGEST_MAX_DIMENSION)
+    try:
+        img = ImageOps.exif_transpose(img)
+
+        mode = "RGBA" if has_alpha(img) else "RGB"
+        icc_profile = img.info.get("icc_profile")
+        if img.mode != mode:
+            img = img.convert(mode)
+        img.thumbnail(
+            max_size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP
+        )
+
+        # only the colour profile is carried over, EXIF, XMP and comments
+        # are dropped by not passing them to the encoder
+        output = io.BytesIO()
+        img.save(
+            output,
+            format="WEBP",
+            lossless=mode == "RGBA",
+            quality=Config.INGEST_QUALITY,
+            method=4,
+            icc_profile=icc_profile,
+        )
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise InvalidImageError("Invalid image file")
+
+    return IngestedImage(
+        output.getvalue(), img.width, img.height, MASTER_FORMAT, MASTER_MIMETYPE
+    )
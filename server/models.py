@@ -1,9 +1,15 @@
 import uuid
+from datetime import timezone
 
 from extensions import db, login_manager
 from flask_login import UserMixin
 
 
+def utc_isoformat(value):
+    # scheduler and scan timestamps are stored as naive UTC
+    return value.replace(tzinfo=timezone.utc).isoformat() if value else None
+
+
 class OAuthConnection(db.Model):
     uuid = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     user_uuid = db.Column(db.String(36), db.ForeignKey("user.uuid"), nullable=False)
@@ -44,8 +50,18 @@ class MarketplaceItem(db.Model):
     description = db.Column(db.Text)
     categories = db.Column(db.JSON)
     is_private = db.Column(db.Boolean, default=False)
+    # of the stored master, filled in when the upload is ingested
     width = db.Column(db.Integer)
     height = db.Column(db.Integer)
+    image_bytes = db.Column(db.Integer)
+    image_format = db.Column(db.String(10))
+    # kept in step by the bookmark routes, `flask bookmarks recount` repairs it
+    bookmark_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    # items uploaded before deduplication have no hash, their image is
+    # stored under the item uuid
+    content_hash = db.Column(db.String(64), db.ForeignKey("blob.sha256"), index=True)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(
         db.DateTime,
@@ -55,9 +71,26 @@ class MarketplaceItem(db.Model):
     author_uuid = db.Column(db.String(36), db.ForeignKey("user.uuid"), nullable=False)
     author = db.relationship("User", backref=db.backref("marketplace_items", lazy=True))
 
+    __table_args__ = (
+        # the public feed newest or most bookmarked first, and an author's items
+        db.Index("ix_marketplace_item_feed", "is_private", "created_at", "uuid"),
+        db.Index("ix_marketplace_item_author", "author_uuid", "created_at"),
+        db.Index(
+            "ix_marketplace_item_popular",
+            "is_private",
+            "bookmark_count",
+            "created_at",
+            "uuid",
+        ),
+    )
+
+    @property
+    def image_key(self):
+        return f"marketplace/{self.content_hash or self.uuid}"
+
     @property
     def image_path(self):
-        return f"/uploads/marketplace/{self.uuid}"
+        return f"/uploads/{self.image_key}"
 
     def to_dict(self):
         return {
@@ -67,6 +100,8 @@ class MarketplaceItem(db.Model):
             "image_path": self.image_path,
             "width": self.width,
             "height": self.height,
+            "image_bytes": self.image_bytes,
+            "image_format": self.image_format,
             "categories": self.categories,
             "is_private": self.is_private,
             "created_at": self.created_at.isoformat(),
@@ -79,6 +114,35 @@ class MarketplaceItem(db.Model):
         }
 
 
+class Blob(db.Model):
+    # an uploaded image stored once under its SHA-256, shared by every item
+    # with the same content and deleted with the last of them
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    # set once the object is in S3, until then every uploader stores it
+    stored = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+
+class ItemCategory(db.Model):
+    # one row per category of an item, mirrors MarketplaceItem.categories so
+    # the feed can filter through an index instead of matching JSON
+    category = db.Column(db.String(30), primary_key=True)
+    item_uuid = db.Column(
+        db.String(36),
+        db.ForeignKey("marketplace_item.uuid"),
+        primary_key=True,
+        index=True,
+    )
+
+
+class CategoryCount(db.Model):
+    # number of public items per category, updated along with ItemCategory
+    category = db.Column(db.String(30), primary_key=True)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Bookmark(db.Model):
     uuid = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     user_uuid = db.Column(db.String(36), db.ForeignKey("user.uuid"), nullable=False)
@@ -98,6 +162,99 @@ class Bookmark(db.Model):
     __table_args__ = (db.UniqueConstraint("user_uuid", "item_uuid"),)
 
 
+class RenditionJob(db.Model):
+    uuid = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    item_uuid = db.Column(db.String(36), nullable=False, index=True)
+    # 'pending', 'running' or 'failed', rows are deleted once rendered
+    status = db.Column(db.String(20), nullable=False, default="pending", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(
+        db.DateTime,
+        default=db.func.current_timestamp(),
+        onupdate=db.func.current_timestamp(),
+    )
+
+
+class TemporaryFile(db.Model):
+    # S3 objects that are deleted once they expire, e.g. background removals
+    key = db.Column(db.String(255), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class OrphanScan(db.Model):
+    uuid = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    status = db.Column(db.String(20), nullable=False, default="running", index=True)
+    # last S3 key that was compared, a paused scan resumes after it
+    checkpoint = db.Column(db.String(255))
+    objects_scanned = db.Column(db.Integer, nullable=False, default=0)
+    orphans_found = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            "uuid": self.uuid,
+            "status": self.status,
+            "objects_scanned": self.objects_scanned,
+            "orphans_found": self.orphans_found,
+            "started_at": utc_isoformat(self.started_at),
+            "finished_at": utc_isoformat(self.finished_at),
+        }
+
+
+class OrphanedFile(db.Model):
+    scan_uuid = db.Column(db.String(36), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    last_modified = db.Column(db.DateTime, nullable=False)
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "size": self.size,
+            "last_modified": utc_isoformat(self.last_modified),
+            "url": f"/uploads/{self.key}",
+        }
+
+
+class CacheGeneration(db.Model):
+    # bumped in the same transaction as every change to what it covers, a
+    # cached response is only served while its generation is current
+    name = db.Column(db.String(50), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SchedulerLease(db.Model):
+    # one row per lease, the holder is the "hostname:pid" renewing it
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100), nullable=False)
+    acquired_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class JobRun(db.Model):
+    uuid = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    job_id = db.Column(db.String(50), nullable=False, index=True)
+    holder = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # 'success' or 'error'
+    detail = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, nullable=False, index=True)
+    duration_ms = db.Column(db.Integer)
+
+    def to_dict(self):
+        return {
+            "uuid": self.uuid,
+            "job_id": self.job_id,
+            "holder": self.holder,
+            "status": self.status,
+            "detail": self.detail,
+            "started_at": utc_isoformat(self.started_at),
+            "duration_ms": self.duration_ms,
+        }
+
+
 @login_manager.user_loader
 def load_user(user_uuid):
     return User.query.get(user_uuid)
@@ -0,0 +1,173 @@
+import heapq
+from datetime import datetime, timezone
+
+from config import Config
+from extensions import db
+from models import Blob, MarketplaceItem, OrphanedFile, OrphanScan
+from s3 import DeleteSummary, delete_keys, iter_objects
+
+PREFIX = "marketplace/"
+NAME_PAGE_SIZE = 1000
+
+
+def iter_names(column, *criteria, start_after=None):
+    """Yield the values of ``column`` in the same byte order S3 lists keys in."""
+    while True:
+        query = db.session.query(column).filter(*criteria)
+        if start_after is not None:
+            query = query.filter(column > start_after)
+        page = [name for (name,) in query.order_by(column).limit(NAME_PAGE_SIZE)]
+        yield from page
+
+        if len(page) < NAME_PAGE_SIZE:
+            return
+        start_after = page[-1]
+
+
+def iter_referenced_names(start_after=None):
+    """Yield every name under PREFIX that is in use, in key order.
+
+    Deduplicated images are stored under their hash, older items under their
+    uuid, the two never collide since uuids contain dashes.
+    """
+    return heapq.merge(
+        iter_names(
+            MarketplaceItem.uuid,
+            MarketplaceItem.content_hash.is_(None),
+            start_after=start_after,
+        ),
+        iter_names(Blob.sha256, start_after=start_after),
+    )
+
+
+def referenced_names(names):
+    names = list(names)
+    items = MarketplaceItem.query.with_entities(MarketplaceItem.uuid).filter(
+        MarketplaceItem.uuid.in_(names), MarketplaceItem.content_hash.is_(None)
+    )
+    blobs = Blob.query.with_entities(Blob.sha256).filter(Blob.sha256.in_(names))
+    return {name for (name,) in items} | {name for (name,) in blobs}
+
+
+def latest_scan():
+    return (
+        OrphanScan.query.filter_by(status="complete")
+        .order_by(OrphanScan.finished_at.desc())
+        .first()
+    )
+
+
+def start_scan():
+    scan = OrphanScan.query.filter_by(status="running").first()
+    if scan is None:
+        scan = OrphanScan(started_at=datetime.utcnow())
+        db.session.add(scan)
+        db.session.commit()
+    return scan
+
+
+def reconcile_orphans(limit=None):
+    """Advance the orphan scan by up to ``limit`` S3 keys, called periodically.
+
+    S3 lists keys in order and referenced names are read in the same order,
+    so the two streams are merge-joined without holding either in memory. The scan
+    checkpoints the last key it compared and the next call resumes after it,
+    a new scan starts once the last complete one is ORPHAN_SCAN_INTERVAL old.
+    Returns None when there is no scan due.
+    """
+    limit = limit or Config.ORPHAN_SCAN_BATCH_SIZE
+
+    scan = OrphanScan.query.filter_by(status="running").first()
+    if scan is None:
+        previous = latest_scan()
+        if (
+            previous
+            and datetime.utcnow() - previous.finished_at < Config.ORPHAN_SCAN_INTERVAL
+        ):
+            return None
+        scan = start_scan()
+
+    grace_cutoff = datetime.now(timezone.utc) - Config.ORPHAN_GRACE_PERIOD
+    names = iter_referenced_names(
+        scan.checkpoint[len(PREFIX) :] if scan.checkpoint else None
+    )
+    referenced = next(names, None)
+    compared = 0
+
+    for obj in iter_objects(PREFIX, start_after=scan.checkpoint):
+        name = obj["Key"][len(PREFIX) :]
+        while referenced is not None and referenced < name:
+            referenced = next(names, None)
+
+        if name != referenced and obj["LastModified"] < grace_cutoff:
+            db.session.merge(
+                OrphanedFile(
+                    scan_uuid=scan.uuid,
+                    key=obj["Key"],
+                    size=obj["Size"],
+                    last_modified=obj["LastModified"].replace(tzinfo=None),
+                )
+            )
+            scan.orphans_found += 1
+
+        scan.checkpoint = obj["Key"]
+        scan.objects_scanned += 1
+        compared += 1
+
+        if compared % Config.S3_LIST_PAGE_SIZE == 0:
+            db.session.commit()
+        if compared >= limit:
+            db.session.commit()
+            return f"{scan.objects_scanned} scanned, paused"
+
+    # the results of older scans are kept until this one can replace them
+    scan.status = "complete"
+    scan.finished_at = datetime.utcnow()
+    OrphanedFile.query.filter(OrphanedFile.scan_uuid != scan.uuid).delete(
+        synchronize_session=False
+    )
+    OrphanScan.query.filter(
+        OrphanScan.uuid != scan.uuid, OrphanScan.status == "complete"
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return f"{scan.objects_scanned} scanned, {scan.orphans_found} orphaned"
+
+
+def delete_orphans(scan):
+    """Delete every orphan a scan found, rechecking each against the database.
+
+    Returns the ``DeleteSummary`` of all batches.
+    """
+    deleted = 0
+    failed = []
+    start_after = ""
+
+    while True:
+        rows = (
+            OrphanedFile.query.filter(
+                OrphanedFile.scan_uuid == scan.uuid, OrphanedFile.key > start_after
+            )
+            .order_by(OrphanedFile.key)
+            .limit(Config.S3_DELETE_BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            break
+        start_after = rows[-1].key
+
+        # an item may have been created for a key since the scan saw it
+        claimed = referenced_names(row.key[len(PREFIX) :] for row in rows)
+        keys = [row.key for row in rows if row.key[len(PREFIX) :] not in claimed]
+
+        summary = delete_keys(keys)
+        refused = {error["Key"] for error in summary.failed}
+        deleted += summary.deleted
+        failed.extend(summary.failed)
+
+        OrphanedFile.query.filter(
+            OrphanedFile.scan_uuid == scan.uuid,
+            OrphanedFile.key.in_([row.key for row in rows if row.key not in refused]),
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    return DeleteSummary(deleted, failed)
@@ -0,0 +1,47 @@
+"""Count the SQL statements an endpoint runs, to catch N+1 queries.
+
+    from querycount import assert_constant_queries
+
+    with app.app_context():
+        assert_constant_queries(client, "/api/marketplace/items?per_page={}")
+
+The path is requested once per page size, and an ``AssertionError`` listing
+the statements is raised if the larger page ran more of them. The database
+needs at least as many rows as the largest page size for this to mean
+anything.
+"""
+
+from contextlib import contextmanager
+
+from extensions import db
+from sqlalchemy import event
+
+
+@contextmanager
+def count_queries():
+    """Collect the statements run on the app's engine while the block runs."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def assert_constant_queries(client, path, sizes=(1, 20)):
+    counts = {}
+    for size in sizes:
+        with count_queries() as statements:
+            response = client.get(path.format(size))
+        assert response.status_code == 200, f"{path.format(size)}: {response.status}"
+        counts[size] = statements
+
+    smallest, largest = counts[min(sizes)], counts[max(sizes)]
+    assert len(largest) <= len(smallest), (
+        f"{path} ran {len(smallest)} statements for {min(sizes)} rows and "
+        f"{len(largest)} for {max(sizes)}:\n" + "\n".join(largest)
+    )
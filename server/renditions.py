@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+import click
+from cache import rendition_cache
+from config import Config
+from extensions import db
+from flask.cli import AppGroup
+from models import MarketplaceItem, RenditionJob
+from routes.uploads import (
+    IMAGE_FORMATS,
+    SINGLE_FLIGHT_TIMEOUT,
+    fetch_source,
+    get_cache_key,
+    snap_to_bucket,
+    store_rendition,
+)
+
+renditions_cli = AppGroup("renditions", help="Pre-generate image renditions.")
+
+# a job still marked running after this long belongs to a worker that died
+STALE_JOB_AGE = timedelta(minutes=10)
+
+
+def enqueue_renditions(item_uuid: str):
+    db.session.add(RenditionJob(item_uuid=item_uuid))
+    db.session.commit()
+
+
+def render_item(key: str, original_width: Optional[int] = None) -> int:
+    """Render the standard renditions of a marketplace image into the cache.
+
+    The original is fetched from S3 once and shared by every rendition.
+    Returns the number of renditions that had to be rendered.
+    """
+    source = None
+    rendered = 0
+
+    for image_format in Config.PRERENDER_FORMATS:
+        if image_format not in IMAGE_FORMATS:
+            continue
+
+        for width, height, quality in Config.PRERENDER_RENDITIONS:
+            # the client never asks for more than the original width and the
+            # route snaps what it asks for, the keys have to be worked out
+            # the same way to be the ones it requests
+            if width and original_width:
+                width = snap_to_bucket(min(width, original_width))
+
+            cache_key = get_cache_key(key, width, height, quality, image_format)
+            with rendition_cache.single_flight(cache_key, SINGLE_FLIGHT_TIMEOUT):
+                if rendition_cache.get(cache_key, count=False):
+                    continue
+
+                if source is None:
+                    source = fetch_source(key)
+
+                store_rendition(cache_key, source, width, height, quality, image_format)
+                rendered += 1
+
+    return rendered
+
+
+def render_pending_renditions(app, limit=10):
+    """Drain the rendition job table, called periodically by the scheduler.
+
+    Returns the number of jobs this call claimed.
+    """
+    stale_before = datetime.utcnow() - STALE_JOB_AGE
+    claimable = (RenditionJob.status == "pending") | (
+        (RenditionJob.status == "running") & (RenditionJob.updated_at < stale_before)
+    )
+    jobs = (
+        RenditionJob.query.filter(claimable)
+        .order_by(RenditionJob.created_at)
+        .limit(limit)
+        .all()
+    )
+
+    processed = 0
+    for job in jobs:
+        # claim the job so other workers draining the table skip it
+        claimed = RenditionJob.query.filter(
+            RenditionJob.uuid == job.uuid, claimable
+        ).update(
+            {
+                "status": "running",
+                "attempts": RenditionJob.attempts + 1,
+                "updated_at": datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if not claimed:
+            continue
+
+        processed += 1
+        db.session.refresh(job)
+        try:
+            item = db.session.get(MarketplaceItem, job.item_uuid)
+            if item:
+                render_item(item.image_key, item.width)
+            db.session.delete(job)
+        except Exception as e:
+            app.logger.error(f"Failed to render item {job.item_uuid}: {str(e)}")
+            job.error = str(e)
+            job.status = (
+                "failed" if job.attempts >= Config.PRERENDER_MAX_ATTEMPTS else "pending"
+            )
+        db.session.commit()
+
+    return processed
+
+
+@renditions_cli.command("backfill")
+def backfill_command():
+    """Render the standard renditions of every existing marketplace item."""
+    items = MarketplaceItem.query.all()
+    total = len(items)
+
+    for index, item in enumerate(items, start=1):
+        try:
+            rendered = render_item(item.image_key, item.width)
+            click.echo(f"[{index}/{total}] {item.uuid}: {rendered} rendered")
+        except Exception as e:
+            click.echo(f"[{index}/{total}] {item.uuid}: failed ({str(e)})", err=True)
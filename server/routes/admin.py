@@ -1,12 +1,32 @@
+import os
 from datetime import datetime, timedelta
 from functools import wraps
 
+from blobs import release_item_image
+from cache import memory_cache, rendition_cache, response_cache
+from cached_views import bump_generation
+from categories import remove_item_categories
+from cleanup import LEASE_NAME
 from config import Config
 from extensions import db
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request
 from flask_login import current_user, login_required
-from models import MarketplaceItem, User
-from s3 import delete_file, get_s3_client
+from models import (
+    JobRun,
+    MarketplaceItem,
+    OrphanedFile,
+    OrphanScan,
+    SchedulerLease,
+    User,
+)
+from orphans import (
+    PREFIX,
+    delete_orphans,
+    latest_scan,
+    referenced_names,
+    start_scan,
+)
+from s3 import get_s3_client, pool_stats
 
 admin_bp = Blueprint("admin", __name__)
 
@@ -37,7 +57,7 @@ def check_admin_status():
 @admin_bp.route("/api/admin/marketplace", methods=["GET"])
 @admin_required
 def get_all_marketplace_items():
-    items = MarketplaceItem.query.all()
+    items = MarketplaceItem.query.options(db.joinedload(MarketplaceItem.author)).all()
     return jsonify(
         [
             {
@@ -56,17 +76,26 @@ def get_all_marketplace_items():
 @admin_bp.route("/api/admin/users", methods=["GET"])
 @admin_required
 def get_all_users():
-    users = User.query.all()
+    items_count = (
+        db.select(db.func.count(MarketplaceItem.uuid))
+        .where(MarketplaceItem.author_uuid == User.uuid)
+        .scalar_subquery()
+    )
+    users = (
+        db.session.query(User, items_count)
+        .options(db.selectinload(User.oauth_connections))
+        .all()
+    )
     return jsonify(
         [
             {
                 "uuid": user.uuid,
                 "name": user.name,
                 "email": user.email,
-                "marketplace_items_count": len(user.marketplace_items),
+                "marketplace_items_count": marketplace_items_count,
                 "oauth_providers": [conn.provider for conn in user.oauth_connections],
             }
-            for user in users
+            for user, marketplace_items_count in users
         ]
     )
 
@@ -77,10 +106,10 @@ def admin_delete_marketplace_item(item_uuid):
     item = MarketplaceItem.query.filter_by(uuid=item_uuid).first_or_404()
 
     try:
-        if item.image_path:
-            delete_file(item.image_path)
-
+        remove_item_categories(item)
+        release_item_image(item)
         db.session.delete(item)
+        bump_generation()
         db.session.commit()
         return "", 204
     except Exception as e:
@@ -114,46 +143,123 @@ def get_admin_stats():
     )
 
 
+@admin_bp.route("/api/admin/cache-stats", methods=["GET"])
+@admin_required
+def get_cache_stats():
+    # memory tier and hit counters are per worker process
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "memory": memory_cache.snapshot(),
+            "disk": rendition_cache.snapshot(),
+            "responses": response_cache.snapshot(),
+        }
+    )
+
+
+@admin_bp.route("/api/admin/s3-stats", methods=["GET"])
+@admin_required
+def get_s3_stats():
+    # each worker has its own client and pool
+    return jsonify(pool_stats())
+
+
+@admin_bp.route("/api/admin/jobs", methods=["GET"])
+@admin_required
+def get_job_runs():
+    limit = min(request.args.get("limit", 50, type=int), 500)
+    query = JobRun.query
+    if request.args.get("job_id"):
+        query = query.filter_by(job_id=request.args["job_id"])
+    runs = query.order_by(JobRun.started_at.desc()).limit(limit).all()
+
+    lease = db.session.get(SchedulerLease, LEASE_NAME)
+    return jsonify(
+        {
+            "leader": (
+                {
+                    "holder": lease.holder,
+                    "acquired_at": lease.acquired_at.isoformat(),
+                    "expires_at": lease.expires_at.isoformat(),
+                }
+                if lease
+                else None
+            ),
+            "runs": [run.to_dict() for run in runs],
+        }
+    )
+
+
 @admin_bp.route("/api/admin/orphaned-files", methods=["GET"])
 @admin_required
 def get_orphaned_files():
-    try:
-        s3 = get_s3_client()
-        response = s3.list_objects_v2(Bucket=Config.S3_BUCKET, Prefix="marketplace/")
+    # results come from the last complete reconciliation scan, see orphans.py
+    page = request.args.get("page", 1, type=int)
+    per_page = min(100, request.args.get("per_page", 24, type=int))
 
-        if "Contents" not in response:
-            return jsonify([])
+    scan = latest_scan()
+    running = OrphanScan.query.filter_by(status="running").first()
+    if scan is None:
+        return jsonify(
+            {
+                "files": [],
+                "has_next": False,
+                "total": 0,
+                "scan": None,
+                "running_scan": running.to_dict() if running else None,
+            }
+        )
+
+    files = (
+        OrphanedFile.query.filter_by(scan_uuid=scan.uuid)
+        .order_by(OrphanedFile.key)
+        .paginate(page=page, per_page=per_page, error_out=False)
+    )
+    return jsonify(
+        {
+            "files": [file.to_dict() for file in files.items],
+            "has_next": files.has_next,
+            "total": files.total,
+            "scan": scan.to_dict(),
+            "running_scan": running.to_dict() if running else None,
+        }
+    )
 
-        db_items = MarketplaceItem.query.all()
-        db_uuids = set(item.uuid for item in db_items)
 
-        orphaned_files = []
-        for obj in response["Contents"]:
-            key = obj["Key"]
-            filename = key.split("/")[-1]
+@admin_bp.route("/api/admin/orphaned-files/scan", methods=["POST"])
+@admin_required
+def start_orphan_scan():
+    # the scheduler picks the scan up on its next run
+    return jsonify(start_scan().to_dict()), 202
 
-            if filename not in db_uuids:
-                orphaned_files.append(
-                    {
-                        "key": key,
-                        "size": obj["Size"],
-                        "last_modified": obj["LastModified"].isoformat(),
-                        "url": f"/uploads/{key}",
-                    }
-                )
 
-        return jsonify(orphaned_files)
+@admin_bp.route("/api/admin/orphaned-files", methods=["DELETE"])
+@admin_required
+def delete_all_orphaned_files():
+    scan = latest_scan()
+    if scan is None:
+        return jsonify({"deleted": 0, "failed": []})
 
+    try:
+        summary = delete_orphans(scan)
+        return jsonify({"deleted": summary.deleted, "failed": summary.failed})
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
 
 @admin_bp.route("/api/admin/orphaned-files/<path:key>", methods=["DELETE"])
 @admin_required
 def delete_orphaned_file(key):
+    # the same image may have been uploaded again since the scan
+    if key.startswith(PREFIX) and referenced_names([key[len(PREFIX) :]]):
+        return jsonify({"error": "File is in use"}), 409
+
     try:
         s3 = get_s3_client()
         s3.delete_object(Bucket=Config.S3_BUCKET, Key=key)
+        OrphanedFile.query.filter_by(key=key).delete()
+        db.session.commit()
         return "", 204
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1,11 +1,13 @@
 import time
 import uuid
-from io import BytesIO
+from datetime import datetime
 from pathlib import Path
 
 import requests
-from extensions import limiter
+from config import Config
+from extensions import db, limiter
 from flask import Blueprint, jsonify, request
+from models import TemporaryFile
 from s3 import upload_file
 from utils import allowed_file
 
@@ -40,6 +42,7 @@ def remove_background():
                 files={"image": file},
                 params={"crop": request.args.get("crop", "")},
                 timeout=15,
+                stream=True,
             )
             response.raise_for_status()
         except (requests.ConnectionError, requests.Timeout):
@@ -55,14 +58,31 @@ def remove_background():
         except requests.RequestException as e:
             return jsonify({"success": False, "message": str(e)}), 500
 
-        file_obj = BytesIO(response.content)
-        relative_path = upload_file(file_obj, "nobg", unique_filename)
+        # indexed before the upload, so there is never an object in the
+        # bucket that cleanup doesn't know about
+        db.session.add(
+            TemporaryFile(
+                key=f"nobg/{unique_filename}",
+                expires_at=datetime.utcnow() + Config.TEMPORARY_FILE_TTL,
+            )
+        )
+        db.session.commit()
+
+        # pipe the result straight into S3 instead of buffering it
+        with response:
+            response.raw.decode_content = True
+            relative_path = upload_file(
+                response.raw,
+                "nobg",
+                unique_filename,
+                content_type=response.headers.get("Content-Type", "image/png"),
+            )
 
         return jsonify(
             {
                 "success": True,
                 "image_path": relative_path,
-                "expires_in": "10 minutes",
+                "expires_in": f"{Config.TEMPORARY_FILE_TTL.seconds // 60} minutes",
             }
         )
 
@@ -1,46 +1,188 @@
+import hashlib
 import json
 
+from blobs import acquire_blob, release_blob, release_item_image, store_blob
+from bookmarks import change_bookmark_count
+from cached_views import BOOKMARKS, MARKETPLACE, bump_generation, cached_view
+from categories import remove_item_categories, sync_item_categories
 from extensions import db, limiter
 from flask import Blueprint, jsonify, request
 from flask_login import current_user, login_required
-from models import Bookmark, MarketplaceItem
-from s3 import delete_file, upload_file
-from utils import allowed_file, sanitize_marketplace_input, validate_marketplace_item
+from ingest import InvalidImageError, ingest_image
+from models import Bookmark, CategoryCount, ItemCategory, MarketplaceItem
+from renditions import enqueue_renditions
+from routes.uploads import PREVIEW_QUALITY, build_rendition_manifest, get_quality_tier
+from search import build_match_query, search_items
+from utils import (
+    allowed_file,
+    decode_cursor,
+    decode_popular_cursor,
+    decode_search_cursor,
+    encode_cursor,
+    encode_popular_cursor,
+    encode_search_cursor,
+    sanitize_marketplace_input,
+    validate_marketplace_item,
+)
 
 marketplace_bp = Blueprint("marketplace", __name__)
 
+MAX_BATCH_ITEMS = 100
+
+
+def serialize_listing_item(item):
+    return {
+        "uuid": item.uuid,
+        "name": item.name,
+        "description": item.description,
+        "image_path": item.image_path,
+        "width": item.width,
+        "height": item.height,
+        "categories": item.categories,
+        "is_private": item.is_private,
+        "created_at": item.created_at.isoformat(),
+        "author": {"name": item.author.name, "uuid": item.author.uuid},
+    }
+
+
+def feed_generations():
+    # bookmark counts only show in the popular feed, so a bookmark leaves the
+    # rest of the cached marketplace alone
+    if request.args.get("sort") == "popular":
+        return (MARKETPLACE, BOOKMARKS)
+    return (MARKETPLACE,)
+
 
 @marketplace_bp.route("/api/marketplace/items", methods=["GET"])
+@cached_view(feed_generations)
 def get_marketplace_items():
     page = max(1, request.args.get("page", 1, type=int))
-    per_page = min(100, request.args.get("per_page", 9, type=int))
+    per_page = max(1, min(100, request.args.get("per_page", 9, type=int)))
     category = request.args.get("category")
     author_uuid = request.args.get("author_uuid")
+    sort = request.args.get("sort", "new")
+    if sort not in ("new", "popular"):
+        return jsonify({"error": "Invalid sort"}), 400
 
-    query = MarketplaceItem.query.filter_by(is_private=False)
+    query = MarketplaceItem.query.options(
+        db.joinedload(MarketplaceItem.author)
+    ).filter_by(is_private=False)
     if category:
-        query = query.filter(MarketplaceItem.categories.contains([category]))
+        query = query.join(
+            ItemCategory, ItemCategory.item_uuid == MarketplaceItem.uuid
+        ).filter(ItemCategory.category == category)
     if author_uuid:
         query = query.filter_by(author_uuid=author_uuid)
 
-    query = query.order_by(MarketplaceItem.created_at.desc())
-    paginated_items = query.paginate(page=page, per_page=per_page, error_out=False)
-
+    # uuid breaks ties between items created in the same second, so the
+    # order is total and a cursor always points at exactly one position
+    order = [MarketplaceItem.created_at, MarketplaceItem.uuid]
+    if sort == "popular":
+        order.insert(0, MarketplaceItem.bookmark_count)
+    query = query.order_by(*[column.desc() for column in order])
+
+    if "cursor" in request.args:
+        # keyset pagination, an empty cursor asks for the first page
+        cursor = request.args["cursor"]
+        if cursor:
+            position = (
+                decode_popular_cursor(cursor)
+                if sort == "popular"
+                else decode_cursor(cursor)
+            )
+            if position is None:
+                return jsonify({"error": "Invalid cursor"}), 400
+            *position, created_at, item_uuid = position
+            # created_at is stored as SQLite's current_timestamp text without
+            # a fraction, the bound value has to be formatted the same way or
+            # equal timestamps wouldn't compare equal
+            position += [
+                db.type_coerce(created_at.isoformat(sep=" "), db.String),
+                item_uuid,
+            ]
+            query = query.filter(db.tuple_(*order) < db.tuple_(*position))
+
+        page_items = query.limit(per_page + 1).all()
+        has_next = len(page_items) > per_page
+        page_items = page_items[:per_page]
+    else:
+        paginated_items = query.paginate(page=page, per_page=per_page, error_out=False)
+        page_items = paginated_items.items
+        has_next = paginated_items.has_next
+
+    items = [serialize_listing_item(item) for item in page_items]
+    if sort == "popular":
+        for item, serialized in zip(page_items, items):
+            serialized["bookmark_count"] = item.bookmark_count
+
+    next_cursor = None
+    if has_next:
+        last = page_items[-1]
+        next_cursor = (
+            encode_popular_cursor(last.bookmark_count, last.created_at, last.uuid)
+            if sort == "popular"
+            else encode_cursor(last.created_at, last.uuid)
+        )
+    return jsonify({"items": items, "has_next": has_next, "next_cursor": next_cursor})
+
+
+@marketplace_bp.route("/api/marketplace/search", methods=["GET"])
+def search_marketplace_items():
+    per_page = max(1, min(100, request.args.get("per_page", 9, type=int)))
+    match = build_match_query(request.args.get("q", ""))
+    if match is None:
+        return jsonify({"items": [], "has_next": False, "next_cursor": None})
+
+    after = None
+    if request.args.get("cursor"):
+        after = decode_search_cursor(request.args["cursor"])
+        if after is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    # private items only ever match for their author
+    viewer_uuid = current_user.uuid if current_user.is_authenticated else None
+    results = search_items(match, viewer_uuid, after, per_page + 1)
+    has_next = len(results) > per_page
+    results = results[:per_page]
+
+    items_by_uuid = {
+        item.uuid: item
+        for item in MarketplaceItem.query.options(
+            db.joinedload(MarketplaceItem.author)
+        ).filter(MarketplaceItem.uuid.in_([item_uuid for item_uuid, _ in results]))
+    }
     items = [
-        {
-            "uuid": item.uuid,
-            "name": item.name,
-            "description": item.description,
-            "image_path": item.image_path,
-            "categories": item.categories,
-            "is_private": item.is_private,
-            "created_at": item.created_at.isoformat(),
-            "author": {"name": item.author.name, "uuid": item.author.uuid},
-        }
-        for item in paginated_items.items
+        serialize_listing_item(items_by_uuid[item_uuid])
+        for item_uuid, _ in results
+        if item_uuid in items_by_uuid
     ]
 
-    return jsonify({"items": items, "has_next": paginated_items.has_next})
+    next_cursor = None
+    if has_next:
+        last_uuid, last_rank = results[-1]
+        next_cursor = encode_search_cursor(last_rank, last_uuid)
+    return jsonify({"items": items, "has_next": has_next, "next_cursor": next_cursor})
+
+
+@marketplace_bp.route("/api/marketplace/categories", methods=["GET"])
+@cached_view()
+def get_marketplace_categories():
+    # counts of public items, maintained as items change
+    limit = max(1, min(200, request.args.get("limit", 50, type=int)))
+    counts = (
+        CategoryCount.query.order_by(
+            CategoryCount.item_count.desc(), CategoryCount.category
+        )
+        .limit(limit)
+        .all()
+    )
+    return jsonify(
+        {
+            "categories": [
+                {"name": count.category, "count": count.item_count} for count in counts
+            ]
+        }
+    )
 
 
 @marketplace_bp.route("/api/marketplace/items", methods=["POST"])
@@ -78,25 +220,49 @@ def create_marketplace_item():
         if not is_valid:
             return jsonify({"error": error_message}), 400
 
+        try:
+            image = ingest_image(file.stream)
+        except InvalidImageError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # masters are stored once per content, a duplicate only takes a reference
+        content_hash = hashlib.sha256(image.data).hexdigest()
+        blob = acquire_blob(content_hash, len(image.data))
+
         new_item = MarketplaceItem(
             name=sanitized_data["name"],
             description=sanitized_data["description"],
             categories=sanitized_data["categories"],
             is_private=sanitized_data["is_private"],
+            width=image.width,
+            height=image.height,
+            image_bytes=len(image.data),
+            image_format=image.format,
+            content_hash=content_hash,
             author_uuid=current_user.uuid,
         )
 
         db.session.add(new_item)
+        db.session.flush()
+        sync_item_categories(new_item)
+        bump_generation()
         db.session.commit()
 
-        try:
-            upload_file(file, "marketplace", new_item.uuid)
-            return jsonify(new_item.to_dict()), 201
+        if not blob.stored:
+            try:
+                store_blob(blob, image.data, image.content_type)
+            except Exception as e:
+                remove_item_categories(new_item)
+                release_blob(content_hash)
+                db.session.delete(new_item)
+                bump_generation()
+                db.session.commit()
+                return jsonify({"error": f"Failed to upload file: {str(e)}"}), 500
 
-        except Exception as e:
-            db.session.delete(new_item)
-            db.session.commit()
-            return jsonify({"error": f"Failed to upload file: {str(e)}"}), 500
+            # renditions are cached by image key, a stored blob has them already
+            enqueue_renditions(new_item.uuid)
+
+        return jsonify(new_item.to_dict()), 201
 
     except json.JSONDecodeError:
         return jsonify({"error": "Invalid categories format"}), 400
@@ -115,10 +281,10 @@ def delete_marketplace_item(item_uuid):
         return jsonify({"error": "Unauthorized"}), 403
 
     try:
-        if item.uuid:
-            delete_file(item.image_path)
-
+        remove_item_categories(item)
+        release_item_image(item)
         db.session.delete(item)
+        bump_generation()
         db.session.commit()
         return "", 204
     except Exception as e:
@@ -153,6 +319,9 @@ def update_marketplace_item(item_uuid):
         if not is_valid:
             return jsonify({"error": error_message}), 400
 
+        previous_categories = item.categories
+        previously_private = item.is_private
+
         if "name" in sanitized_data:
             item.name = sanitized_data["name"]
         if "description" in sanitized_data:
@@ -162,6 +331,8 @@ def update_marketplace_item(item_uuid):
         if "is_private" in sanitized_data:
             item.is_private = sanitized_data["is_private"]
 
+        sync_item_categories(item, previous_categories, previously_private)
+        bump_generation()
         db.session.commit()
         return jsonify(item.to_dict())
 
@@ -172,7 +343,41 @@ def update_marketplace_item(item_uuid):
         return jsonify({"error": "Internal server error"}), 500
 
 
+@marketplace_bp.route("/api/marketplace/items/batch", methods=["POST"])
+def get_marketplace_items_batch():
+    data = request.get_json(silent=True)
+    item_uuids = data.get("uuids") if isinstance(data, dict) else None
+    if not isinstance(item_uuids, list) or not all(
+        isinstance(item_uuid, str) for item_uuid in item_uuids
+    ):
+        return jsonify({"error": "uuids must be a list of strings"}), 400
+
+    item_uuids = list(dict.fromkeys(item_uuids))
+    if len(item_uuids) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"At most {MAX_BATCH_ITEMS} uuids per batch"}), 400
+
+    viewer_uuid = current_user.uuid if current_user.is_authenticated else None
+    found = {
+        item.uuid: item
+        for item in MarketplaceItem.query.options(
+            db.joinedload(MarketplaceItem.author)
+        ).filter(MarketplaceItem.uuid.in_(item_uuids))
+    }
+
+    # private items of other authors look the same as missing ones
+    items = {}
+    for item_uuid in item_uuids:
+        item = found.get(item_uuid)
+        if item is None or (item.is_private and item.author_uuid != viewer_uuid):
+            items[item_uuid] = {"error": "Not found"}
+        else:
+            items[item_uuid] = item.to_dict()
+
+    return jsonify({"items": items})
+
+
 @marketplace_bp.route("/api/marketplace/items/<string:item_uuid>", methods=["GET"])
+@cached_view()
 def get_marketplace_item(item_uuid):
     item = MarketplaceItem.query.filter_by(uuid=item_uuid).first_or_404()
 
@@ -181,14 +386,54 @@ def get_marketplace_item(item_uuid):
     ):
         return jsonify({"error": "Not found"}), 404
 
-    return jsonify(item.to_dict())
+    response = jsonify(item.to_dict())
+    # only the author sees a private item, so it never goes in the shared cache
+    response.cache_control.private = item.is_private
+    return response
+
+
+@marketplace_bp.route(
+    "/api/marketplace/items/<string:item_uuid>/renditions", methods=["GET"]
+)
+def get_marketplace_item_renditions(item_uuid):
+    item = MarketplaceItem.query.filter_by(uuid=item_uuid).first_or_404()
+
+    if item.is_private and (
+        not current_user.is_authenticated or item.author_uuid != current_user.uuid
+    ):
+        return jsonify({"error": "Not found"}), 404
+
+    quality = get_quality_tier(request.args.get("q", PREVIEW_QUALITY, type=int))
+    return jsonify(
+        {
+            "uuid": item.uuid,
+            "width": item.width,
+            "height": item.height,
+            "quality": quality,
+            "formats": build_rendition_manifest(
+                item.image_key, item.width, item.height, quality
+            ),
+        }
+    )
 
 
 @marketplace_bp.route("/api/marketplace/bookmarks", methods=["GET"])
 @login_required
 def get_bookmarks():
-    bookmarks = Bookmark.query.filter_by(user_uuid=current_user.uuid).all()
-    return jsonify({"bookmarks": [bookmark.item.to_dict() for bookmark in bookmarks]})
+    bookmarks = (
+        Bookmark.query.options(
+            db.joinedload(Bookmark.item).joinedload(MarketplaceItem.author)
+        )
+        .filter_by(user_uuid=current_user.uuid)
+        .all()
+    )
+    return jsonify(
+        {
+            "bookmarks": [
+                bookmark.item.to_dict() for bookmark in bookmarks if bookmark.item
+            ]
+        }
+    )
 
 
 @marketplace_bp.route("/api/marketplace/bookmarks/<string:item_uuid>", methods=["POST"])
@@ -204,6 +449,8 @@ def add_bookmark(item_uuid):
 
     bookmark = Bookmark(user_uuid=current_user.uuid, item_uuid=item.uuid)
     db.session.add(bookmark)
+    change_bookmark_count(item.uuid, 1)
+    bump_generation(BOOKMARKS)
     db.session.commit()
 
     return jsonify({"message": "Bookmarked successfully"}), 201
@@ -219,6 +466,8 @@ def remove_bookmark(item_uuid):
     ).first_or_404()
 
     db.session.delete(bookmark)
+    change_bookmark_count(item_uuid, -1)
+    bump_generation(BOOKMARKS)
     db.session.commit()
 
     return "", 204
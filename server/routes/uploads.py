@@ -1,37 +1,122 @@
+import bisect
 import hashlib
 import io
-import os
-from datetime import datetime
-from pathlib import Path
+from datetime import datetime, timezone
+from typing import NamedTuple
 
+from cache import memory_cache, rendition_cache
 from config import Config
-from flask import Blueprint, abort, request, send_file
-from PIL import Image
-from s3 import get_s3_client
+from flask import Blueprint, Response, abort, request, send_file
+from PIL import Image, UnidentifiedImageError
+from s3 import get_s3_client, is_not_found
 from werkzeug.utils import secure_filename
 
+try:
+    import pillow_avif  # noqa: F401, registers the AVIF codec with Pillow
+except ImportError:
+    pass
+
 uploads_bp = Blueprint("uploads", __name__)
 
 VALID_FOLDERS = ["nobg", "marketplace"]
-CACHE_DIR = Config.CACHE_DIR
 CACHE_DURATION = Config.CACHE_DURATION
-MAX_CACHE_SIZE_BYTES = Config.MAX_CACHE_SIZE_BYTES
 THUMBNAIL_QUALITY = Config.THUMBNAIL_QUALITY
 PREVIEW_QUALITY = Config.PREVIEW_QUALITY
 FULL_QUALITY = Config.FULL_QUALITY
+SINGLE_FLIGHT_TIMEOUT = Config.SINGLE_FLIGHT_TIMEOUT
+NOT_FOUND_CACHE_TTL = Config.NOT_FOUND_CACHE_TTL
+UNDECODABLE_CACHE_TTL = Config.UNDECODABLE_CACHE_TTL
+CACHE_ACCEL_REDIRECT = Config.CACHE_ACCEL_REDIRECT
+CACHE_ACCEL_PREFIX = Config.CACHE_ACCEL_PREFIX
+RENDITION_SIZES = sorted(Config.RENDITION_SIZES)
+RESIZE_REDUCING_GAP = 2
+
+Image.init()
+AVIF_SUPPORTED = "AVIF" in Image.SAVE
+
+# output formats in order of preference, with the encoder quality used for
+# each of the quality tiers above
+IMAGE_FORMATS = {
+    "avif": {
+        "mimetype": "image/avif",
+        "quality": {
+            THUMBNAIL_QUALITY: Config.AVIF_THUMBNAIL_QUALITY,
+            PREVIEW_QUALITY: Config.AVIF_PREVIEW_QUALITY,
+            FULL_QUALITY: Config.AVIF_FULL_QUALITY,
+        },
+    },
+    "webp": {
+        "mimetype": "image/webp",
+        "quality": {
+            THUMBNAIL_QUALITY: THUMBNAIL_QUALITY,
+            PREVIEW_QUALITY: PREVIEW_QUALITY,
+            FULL_QUALITY: FULL_QUALITY,
+        },
+    },
+    "jpeg": {
+        "mimetype": "image/jpeg",
+        "quality": {
+            THUMBNAIL_QUALITY: Config.JPEG_THUMBNAIL_QUALITY,
+            PREVIEW_QUALITY: Config.JPEG_PREVIEW_QUALITY,
+            FULL_QUALITY: Config.JPEG_FULL_QUALITY,
+        },
+    },
+}
+if not AVIF_SUPPORTED:
+    del IMAGE_FORMATS["avif"]
+
+
+def get_quality_tier(requested_quality):
+    if requested_quality <= THUMBNAIL_QUALITY:
+        return THUMBNAIL_QUALITY
+    if requested_quality <= PREVIEW_QUALITY:
+        return PREVIEW_QUALITY
+    return FULL_QUALITY
+
+
+def snap_to_bucket(size):
+    """Round a requested dimension up to the nearest rendition size."""
+    if not size or size <= 0:
+        return None
+    index = bisect.bisect_left(RENDITION_SIZES, size)
+    return RENDITION_SIZES[min(index, len(RENDITION_SIZES) - 1)]
 
 
-def get_cache_key(key, width, height, quality):
-    params = f"{key}-{width}-{height}-{quality}"
+def get_cache_key(key, width, height, quality, image_format):
+    params = f"{key}-{width}-{height}-{quality}-{image_format}"
     return hashlib.md5(params.encode()).hexdigest()
 
 
-def optimize_image(image_data, width=None, height=None, quality=PREVIEW_QUALITY):
-    img = Image.open(io.BytesIO(image_data))
+def negotiate_format():
+    """Pick the output format, returns (format, whether Accept was used)."""
+    requested = request.args.get("fmt", "").lower()
+    if requested == "jpg":
+        requested = "jpeg"
+    if requested in IMAGE_FORMATS:
+        return requested, False
+
+    accept = request.accept_mimetypes
+    # only an explicit avif entry counts, */* from non-browser clients doesn't
+    if AVIF_SUPPORTED and any(value == "image/avif" and q > 0 for value, q in accept):
+        return "avif", True
+
+    best = accept.best_match(["image/webp", "image/jpeg"], default="image/webp")
+    return ("jpeg" if best == "image/jpeg" else "webp"), True
 
-    if img.mode not in ("RGBA", "RGB"):
-        img = img.convert("RGB")
 
+def has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or (
+        img.mode == "P" and "transparency" in img.info
+    )
+
+
+def optimize_image(
+    image_data, width=None, height=None, quality=PREVIEW_QUALITY, image_format="webp"
+):
+    img = Image.open(io.BytesIO(image_data))
+
+    # work out the target size from the header before anything is decoded
+    new_size = None
     if width or height:
         original_width, original_height = img.size
 
@@ -50,82 +135,220 @@ def optimize_image(image_data, width=None, height=None, quality=PREVIEW_QUALITY)
             ratio = float(height) / original_height
             new_size = (int(original_width * ratio), int(height))
 
-        if new_size != img.size:
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
+        if new_size == img.size:
+            new_size = None
+
+    if new_size and img.format == "JPEG":
+        # let libjpeg decode at 1/2, 1/4 or 1/8 scale, keeping enough pixels
+        # for the final resample to stay sharp
+        img.draft(
+            None, (new_size[0] * RESIZE_REDUCING_GAP, new_size[1] * RESIZE_REDUCING_GAP)
+        )
+
+    # only keep an alpha channel when the source actually has one
+    mode = "RGBA" if has_alpha(img) else "RGB"
+    if img.mode != mode:
+        img = img.convert(mode)
+
+    if new_size and new_size != img.size:
+        # reducing_gap shrinks by an integer factor with reduce() first and
+        # leaves only the last step to LANCZOS
+        img = img.resize(
+            new_size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP
+        )
 
     output = io.BytesIO()
-    img.save(output, format="WEBP", quality=quality, method=4)
+    if image_format == "avif":
+        img.save(output, format="AVIF", quality=quality, speed=6)
+    elif image_format == "jpeg":
+        if img.mode == "RGBA":
+            # jpeg has no alpha, flatten onto white instead of black
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        img.save(
+            output, format="JPEG", quality=quality, optimize=True, progressive=True
+        )
+    else:
+        img.save(output, format="WEBP", quality=quality, method=4)
     output.seek(0)
     return output
 
 
-def add_cache_headers(response, max_age=None):
+class UndecodableImageError(Exception):
+    pass
+
+
+class SourceImage(NamedTuple):
+    data: bytes
+    etag: str
+    last_modified: float
+
+
+def fetch_source(key):
+    s3 = get_s3_client()
+    response = s3.get_object(Bucket=Config.S3_BUCKET, Key=key)
+    return SourceImage(
+        response["Body"].read(),
+        response["ETag"].strip('"'),
+        response["LastModified"].timestamp(),
+    )
+
+
+def get_rendition_etag(source, cache_key):
+    # the same source with the same parameters always encodes to the same
+    # bytes, so the ETag is known without reading the rendition
+    return hashlib.md5(f"{source.etag}-{cache_key}".encode()).hexdigest()
+
+
+def store_rendition(cache_key, source, width, height, quality, image_format):
+    """Encode a rendition of a source image and write it to the disk cache."""
+    try:
+        optimized = optimize_image(
+            source.data,
+            width,
+            height,
+            IMAGE_FORMATS[image_format]["quality"][quality],
+            image_format,
+        )
+    except (
+        UnidentifiedImageError,
+        Image.DecompressionBombError,
+        OSError,
+        SyntaxError,
+        ValueError,
+    ) as e:
+        raise UndecodableImageError(str(e)) from e
+
+    # the one copy of the encoded bytes, shared by the disk write, the memory
+    # tier and the response body
+    data = optimized.getvalue()
+    etag = get_rendition_etag(source, cache_key)
+    entry = rendition_cache.put(cache_key, data, etag, source.last_modified)
+    return data, entry
+
+
+def build_rendition_manifest(
+    key, original_width=None, original_height=None, quality=PREVIEW_QUALITY
+):
+    """List the width renditions of an upload per format, for srcset.
+
+    Widths above the original are skipped since we never upscale, the
+    original itself is offered through the next bucket up. Byte sizes are
+    only known for renditions that are already in the disk cache.
+    """
+    widths = []
+    for size in RENDITION_SIZES:
+        if original_width and size >= original_width:
+            widths.append((size, original_width))
+            break
+        widths.append((size, size))
+
+    manifest = {}
+    for image_format, options in IMAGE_FORMATS.items():
+        cache_keys = {
+            size: get_cache_key(key, size, None, quality, image_format)
+            for size, _ in widths
+        }
+        sizes = rendition_cache.sizes(cache_keys.values())
+
+        renditions = [
+            {
+                "url": f"/uploads/{key}?w={size}&q={quality}&fmt={image_format}",
+                "width": width,
+                "height": (
+                    round(original_height * width / original_width)
+                    if original_width and original_height
+                    else None
+                ),
+                "bytes": sizes.get(cache_keys[size]),
+            }
+            for size, width in widths
+        ]
+        manifest[image_format] = {
+            "mimetype": options["mimetype"],
+            "renditions": renditions,
+            "srcset": ", ".join(f"{r['url']} {r['width']}w" for r in renditions),
+        }
+
+    return manifest
+
+
+def add_cache_headers(response, max_age=None, negotiated=False):
     if max_age is None:
         max_age = int(CACHE_DURATION.total_seconds())
 
     response.headers["Cache-Control"] = (
         f"public, max-age={max_age}, stale-while-revalidate=60"
     )
-    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Vary"] = (
+        "Accept, Accept-Encoding" if negotiated else "Accept-Encoding"
+    )
     return response
 
 
-def cleanup_old_cache_files():
-    now = datetime.now().timestamp()
-    cache_dir = Path(CACHE_DIR)
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return int(last_modified) <= request.if_modified_since.timestamp()
+    return False
 
-    if not cache_dir.exists():
-        return
 
-    for cache_file in cache_dir.iterdir():
-        if not cache_file.is_file():
-            continue
-        file_age = now - cache_file.stat().st_mtime
-        if file_age > CACHE_DURATION.total_seconds():
-            try:
-                cache_file.unlink()
-            except OSError:
-                pass
+def send_not_modified(etag, last_modified, negotiated):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    return add_cache_headers(response, negotiated=negotiated)
 
 
-def maintain_cache_size():
-    cache_dir = Path(CACHE_DIR)
-    if not cache_dir.exists():
-        return
-
-    cache_files = []
-    total_size = 0
-
-    for cache_file in cache_dir.iterdir():
-        if not cache_file.is_file():
-            continue
-        stats = cache_file.stat()
-        total_size += stats.st_size
-        cache_files.append((stats.st_mtime, stats.st_size, cache_file))
+def send_rendition(source, etag, last_modified, image_format, negotiated):
+    mimetype = IMAGE_FORMATS[image_format]["mimetype"]
+    last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    if isinstance(source, bytes):
+        # in-memory renditions go out as a single body, not a chunked file
+        response = Response(source, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.make_conditional(request)
+    else:
+        response = send_file(
+            source,
+            mimetype=mimetype,
+            etag=etag,
+            last_modified=last_modified,
+            conditional=True,
+        )
+    return add_cache_headers(response, negotiated=negotiated)
 
-    if total_size > MAX_CACHE_SIZE_BYTES:
-        cache_files.sort()
-
-        for mtime, size, file_path in cache_files:
-            if total_size <= MAX_CACHE_SIZE_BYTES:
-                break
-            try:
-                file_path.unlink()
-                total_size -= size
-            except OSError:
-                pass
 
+def send_accel_redirect(cache_key, entry, image_format, negotiated):
+    response = Response(mimetype=IMAGE_FORMATS[image_format]["mimetype"])
+    response.headers["X-Accel-Redirect"] = (
+        CACHE_ACCEL_PREFIX + rendition_cache.relative_path(cache_key)
+    )
+    response.set_etag(entry.etag)
+    return add_cache_headers(response, negotiated=negotiated)
 
-def cache_image(cache_path: str, image_data: bytes):
-    """Cache image data and maintain cache limits."""
-    os.makedirs(CACHE_DIR, exist_ok=True)
 
-    cleanup_old_cache_files()
+def send_cached_file(cache_key, entry, image_format, negotiated):
+    if CACHE_ACCEL_REDIRECT:
+        return send_accel_redirect(cache_key, entry, image_format, negotiated)
 
-    with open(cache_path, "wb") as f:
-        f.write(image_data)
+    # promote disk hits so the next request for a hot image stays in memory
+    if entry.size <= memory_cache.max_item_size:
+        with open(entry.path, "rb") as f:
+            data = f.read()
+        memory_cache.put(
+            cache_key, data, entry.etag, entry.last_modified, entry.expires_at
+        )
+        source = data
+    else:
+        source = entry.path
 
-    maintain_cache_size()
+    return send_rendition(
+        source, entry.etag, entry.last_modified, image_format, negotiated
+    )
 
 
 @uploads_bp.route("/uploads/<folder>/<path:filename>")
@@ -136,44 +359,72 @@ def serve_uploaded_file(folder, filename):
     filename = secure_filename(filename)
     key = f"{folder}/{filename}"
 
-    width = request.args.get("w", type=int)
-    height = request.args.get("h", type=int)
-    requested_quality = request.args.get("q", PREVIEW_QUALITY, type=int)
-
-    if requested_quality <= THUMBNAIL_QUALITY:
-        quality = THUMBNAIL_QUALITY
-    elif requested_quality <= PREVIEW_QUALITY:
-        quality = PREVIEW_QUALITY
-    else:
-        quality = FULL_QUALITY
+    # snapping both sides on their own would distort the image, with a width
+    # the height follows from the source's aspect ratio
+    width = snap_to_bucket(request.args.get("w", type=int))
+    height = None if width else snap_to_bucket(request.args.get("h", type=int))
+    quality = get_quality_tier(request.args.get("q", PREVIEW_QUALITY, type=int))
+    image_format, negotiated = negotiate_format()
 
     try:
-        s3 = get_s3_client()
-        cache_key = get_cache_key(key, width, height, quality)
-        cache_path = os.path.join(CACHE_DIR, cache_key)
-
-        if os.path.exists(cache_path):
-            response = send_file(
-                cache_path,
-                mimetype="image/webp",
-                conditional=True,
+        cache_key = get_cache_key(key, width, height, quality, image_format)
+
+        # with nginx serving disk hits the memory tier would only keep
+        # workers busy, so it's skipped entirely
+        cached = None if CACHE_ACCEL_REDIRECT else memory_cache.get(cache_key)
+        if cached:
+            return send_rendition(
+                cached.data, cached.etag, cached.last_modified, image_format, negotiated
             )
-            return add_cache_headers(response)
-
-        response = s3.get_object(Bucket=Config.S3_BUCKET, Key=key)
-        image_data = response["Body"].read()
-        optimized = optimize_image(image_data, width, height, quality)
 
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        with open(cache_path, "wb") as f:
-            f.write(optimized.getvalue())
+        # revalidations of disk entries are answered from the index alone
+        if request.if_none_match or request.if_modified_since:
+            validators = rendition_cache.validators(cache_key)
+            if validators and is_not_modified(*validators):
+                return send_not_modified(*validators, negotiated)
+
+        # a miss is counted by the lookup after waiting for the producer
+        cached = rendition_cache.get(cache_key, count_miss=False)
+        if cached:
+            return send_cached_file(cache_key, cached, image_format, negotiated)
+
+        # keys that were just missing or broken are answered without asking
+        # S3 again, uploads and deletes clear the entry early
+        if rendition_cache.failure(key):
+            return abort(404)
+
+        # only one worker fetches and encodes a given rendition, the others
+        # wait for it and then serve the cached file
+        with rendition_cache.single_flight(cache_key, SINGLE_FLIGHT_TIMEOUT):
+            # a request that waited for another worker to render it is a hit
+            cached = rendition_cache.get(cache_key)
+            if cached:
+                return send_cached_file(cache_key, cached, image_format, negotiated)
 
-        cache_image(cache_path, optimized.getvalue())
-
-        response = send_file(
-            io.BytesIO(optimized.getvalue()), mimetype="image/webp", conditional=True
+            try:
+                source = fetch_source(key)
+                data, entry = store_rendition(
+                    cache_key, source, width, height, quality, image_format
+                )
+            except UndecodableImageError:
+                rendition_cache.record_failure(
+                    key, "undecodable", UNDECODABLE_CACHE_TTL.total_seconds()
+                )
+                raise
+            except Exception as e:
+                if is_not_found(e):
+                    rendition_cache.record_failure(
+                        key, "not_found", NOT_FOUND_CACHE_TTL.total_seconds()
+                    )
+                raise
+            if not CACHE_ACCEL_REDIRECT:
+                memory_cache.put(
+                    cache_key, data, entry.etag, entry.last_modified, entry.expires_at
+                )
+
+        return send_rendition(
+            data, entry.etag, entry.last_modified, image_format, negotiated
         )
-        return add_cache_headers(response)
 
     except Exception as e:
         return abort(404)
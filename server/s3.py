@@ -1,43 +1,160 @@
-from typing import BinaryIO, Union
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import (
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from botocore.exceptions import ClientError
+from cache import rendition_cache
 from config import Config as AppConfig
 from werkzeug.datastructures import FileStorage
 
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
 
 def get_s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=AppConfig.S3_ENDPOINT,
-        aws_access_key_id=AppConfig.S3_ACCESS_KEY,
-        aws_secret_access_key=AppConfig.S3_SECRET_KEY,
-        config=Config(signature_version="s3v4"),
+    """Return this process's S3 client, creating it on first use.
+
+    boto3 clients are thread-safe and keep a pool of open connections, so one
+    is shared by every request in the worker. gunicorn --preload forks workers
+    after the app is imported, and a client inherited across a fork would
+    share its sockets with the parent, so the client is keyed on the pid.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            _client = boto3.client(
+                "s3",
+                endpoint_url=AppConfig.S3_ENDPOINT,
+                aws_access_key_id=AppConfig.S3_ACCESS_KEY,
+                aws_secret_access_key=AppConfig.S3_SECRET_KEY,
+                config=Config(
+                    signature_version="s3v4",
+                    max_pool_connections=AppConfig.S3_MAX_POOL_CONNECTIONS,
+                    connect_timeout=AppConfig.S3_CONNECT_TIMEOUT,
+                    read_timeout=AppConfig.S3_READ_TIMEOUT,
+                    retries={
+                        "total_max_attempts": AppConfig.S3_MAX_ATTEMPTS,
+                        "mode": AppConfig.S3_RETRY_MODE,
+                    },
+                ),
+            )
+            _client_pid = pid
+        return _client
+
+
+def pool_stats() -> dict:
+    """Connection pool usage of this process's S3 client."""
+    stats = {
+        "pid": os.getpid(),
+        "max_pool_connections": AppConfig.S3_MAX_POOL_CONNECTIONS,
+        "pools": [],
+    }
+    if _client is None or _client_pid != os.getpid():
+        return stats
+
+    # botocore doesn't expose its urllib3 pools, so this reaches into the
+    # endpoint's session and reports nothing if the layout ever changes
+    manager = getattr(
+        getattr(_client._endpoint, "http_session", None), "_manager", None
     )
+    if manager is None:
+        return stats
+
+    for pool_key in manager.pools.keys():
+        pool = manager.pools.get(pool_key)
+        if pool is None:
+            continue
+        # the queue holds idle connections plus empty slots, whatever is
+        # missing from it is checked out
+        stats["pools"].append(
+            {
+                "host": pool.host,
+                "in_use": pool.pool.maxsize - pool.pool.qsize() if pool.pool else 0,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+        )
+    return stats
+
+
+class _UnclosedStream:
+    """Wraps a stream so that upload_fileobj can't close it, the caller owns it."""
 
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
 
-def upload_file(file: Union[FileStorage, BinaryIO], folder: str, filename: str) -> str:
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def close(self):
+        pass
+
+
+def get_transfer_config() -> TransferConfig:
+    # at most max_concurrency parts are buffered at once, which bounds the
+    # memory an upload takes whatever the size of the file
+    return TransferConfig(
+        multipart_threshold=AppConfig.S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=AppConfig.S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=AppConfig.S3_MULTIPART_CONCURRENCY,
+    )
+
+
+def upload_file(
+    file: Union[FileStorage, BinaryIO],
+    folder: str,
+    filename: str,
+    content_type: Optional[str] = None,
+) -> str:
+    """Stream a file to S3, switching to a multipart upload for large files.
+
+    ``file`` can be an uploaded ``FileStorage`` or any readable stream, like
+    the raw body of an HTTP response, it is read in chunks and never held in
+    memory whole.
+    """
     s3 = get_s3_client()
     key = f"{folder}/{filename}"
 
     if isinstance(file, FileStorage):
-        file_data = file.read()
-        content_type = file.content_type
+        stream = file.stream
+        content_type = content_type or file.content_type
     else:
-        file_data = file.read()
-        content_type = "image/png"  # default to PNG for binary data
+        stream = file
+        content_type = content_type or "image/png"  # default to PNG for binary data
 
     try:
-        s3.put_object(
-            Bucket=AppConfig.S3_BUCKET,
-            Key=key,
-            Body=file_data,
-            ContentType=content_type,
+        s3.upload_fileobj(
+            _UnclosedStream(stream),
+            AppConfig.S3_BUCKET,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=get_transfer_config(),
         )
 
         if isinstance(file, FileStorage):
             file.seek(0)
 
+        rendition_cache.clear_failure(key)
         return f"/uploads/{key}"  # keep the same URL format as before
 
     except Exception as e:
@@ -49,6 +166,87 @@ def delete_file(file_path: str) -> bool:
         key = file_path.replace("/uploads/", "", 1)
         s3 = get_s3_client()
         s3.delete_object(Bucket=AppConfig.S3_BUCKET, Key=key)
+        rendition_cache.clear_failure(key)
         return True
     except Exception:
         return False
+
+
+def iter_objects(prefix: str, start_after: Optional[str] = None) -> Iterator[dict]:
+    """Yield every object under ``prefix`` in key order, one listing page at a time.
+
+    ``start_after`` resumes a listing after the last key that was processed.
+    """
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    kwargs = {"StartAfter": start_after} if start_after else {}
+    for page in paginator.paginate(
+        Bucket=AppConfig.S3_BUCKET,
+        Prefix=prefix,
+        PaginationConfig={"PageSize": AppConfig.S3_LIST_PAGE_SIZE},
+        **kwargs,
+    ):
+        yield from page.get("Contents", [])
+
+
+class DeleteSummary(NamedTuple):
+    deleted: int
+    failed: List[dict]  # {"Key", "Code", "Message"} as reported by S3
+
+
+def _delete_batch(keys: List[str]) -> DeleteSummary:
+    try:
+        response = get_s3_client().delete_objects(
+            Bucket=AppConfig.S3_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+    except Exception as e:
+        return DeleteSummary(
+            0, [{"Key": key, "Code": "", "Message": str(e)} for key in keys]
+        )
+
+    # quiet mode only reports the keys that couldn't be deleted
+    failed = response.get("Errors", [])
+    return DeleteSummary(len(keys) - len(failed), failed)
+
+
+def delete_keys(
+    keys: Iterable[str],
+    on_progress: Optional[Callable[[DeleteSummary], None]] = None,
+) -> DeleteSummary:
+    """Delete keys in batches of up to 1000, several batches at a time.
+
+    ``keys`` is consumed lazily so a listing can be piped straight in, only
+    the batches in flight are held in memory. ``on_progress`` is called with
+    the running totals after every batch.
+    """
+    keys = iter(keys)
+    deleted = 0
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=AppConfig.S3_DELETE_CONCURRENCY) as executor:
+        pending = set()
+        while True:
+            while len(pending) < AppConfig.S3_DELETE_CONCURRENCY:
+                batch = list(islice(keys, AppConfig.S3_DELETE_BATCH_SIZE))
+                if not batch:
+                    break
+                pending.add(executor.submit(_delete_batch, batch))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                deleted += result.deleted
+                failed.extend(result.failed)
+                if on_progress:
+                    on_progress(DeleteSummary(deleted, failed))
+
+    return DeleteSummary(deleted, failed)
+
+
+def is_not_found(error: Exception) -> bool:
+    if not isinstance(error, ClientError):
+        return False
+    return error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")
@@ -0,0 +1,55 @@
+from bookmarks import recount_bookmarks
+from categories import rebuild_categories
+from extensions import db
+from models import ItemCategory, MarketplaceItem
+from search import create_search_index
+
+
+def add_column(table, column):
+    # SQLite can only add nullable columns or ones with a constant default,
+    # and doesn't enforce the foreign keys of added columns
+    column_type = column.type.compile(db.engine.dialect)
+    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(ddl)
+
+
+def upgrade_schema():
+    """Create the schema and add what db.create_all() skips on existing tables.
+
+    There are no migrations, create_all only creates missing tables, so
+    indexes added to existing models are created here, as well as the data
+    of tables that are derived from existing ones and the search index.
+    Columns added to existing models are added too, they have to be
+    nullable or have a server default.
+    """
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    db.create_all()
+
+    added_columns = set()
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                add_column(table, column)
+                added_columns.add((table.name, column.name))
+
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine, checkfirst=True)
+
+    if existing_tables and ItemCategory.__tablename__ not in existing_tables:
+        rebuild_categories()
+    if (MarketplaceItem.__tablename__, "bookmark_count") in added_columns:
+        recount_bookmarks()
+
+    create_search_index()
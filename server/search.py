@@ -0,0 +1,122 @@
+import re
+
+from extensions import db
+
+# matches on the name count the most, then categories, then the description,
+# the uuid column isn't searched
+RANK = "bm25(marketplace_item_fts, 0.0, 10.0, 1.0, 5.0)"
+
+# categories are stored as a JSON list, the index gets them space separated
+CATEGORIES_TEXT = "(SELECT group_concat(value, ' ') FROM json_each({}.categories))"
+
+SEARCH_TRIGGERS = [
+    "marketplace_item_fts_insert",
+    "marketplace_item_fts_delete",
+    "marketplace_item_fts_update",
+]
+
+# rows are tied to items by uuid, marketplace_item has a text primary key so
+# its implicit rowids can be renumbered by VACUUM
+SEARCH_INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE marketplace_item_fts USING fts5(
+        uuid UNINDEXED, name, description, categories,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """,
+    f"""
+    CREATE TRIGGER marketplace_item_fts_insert AFTER INSERT ON marketplace_item
+    BEGIN
+        INSERT INTO marketplace_item_fts (uuid, name, description, categories)
+        VALUES (new.uuid, new.name, new.description, {CATEGORIES_TEXT.format("new")});
+    END
+    """,
+    """
+    CREATE TRIGGER marketplace_item_fts_delete AFTER DELETE ON marketplace_item
+    BEGIN
+        DELETE FROM marketplace_item_fts WHERE uuid = old.uuid;
+    END
+    """,
+    f"""
+    CREATE TRIGGER marketplace_item_fts_update
+    AFTER UPDATE OF name, description, categories ON marketplace_item
+    BEGIN
+        DELETE FROM marketplace_item_fts WHERE uuid = old.uuid;
+        INSERT INTO marketplace_item_fts (uuid, name, description, categories)
+        VALUES (new.uuid, new.name, new.description, {CATEGORIES_TEXT.format("new")});
+    END
+    """,
+    f"""
+    INSERT INTO marketplace_item_fts (uuid, name, description, categories)
+    SELECT uuid, name, description, {CATEGORIES_TEXT.format("marketplace_item")}
+    FROM marketplace_item
+    """,
+]
+
+
+def create_search_index():
+    """Create the full-text index and its triggers, filled from existing items.
+
+    An index from before items were tied to it by uuid is rebuilt.
+    """
+    with db.engine.begin() as conn:
+        columns = {
+            row[1]
+            for row in conn.exec_driver_sql("PRAGMA table_info(marketplace_item_fts)")
+        }
+        if "uuid" in columns:
+            return
+
+        if columns:
+            for trigger in SEARCH_TRIGGERS:
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.exec_driver_sql("DROP TABLE marketplace_item_fts")
+
+        for statement in SEARCH_INDEX_DDL:
+            conn.exec_driver_sql(statement)
+
+
+def build_match_query(query):
+    """Turn user input into an FTS5 query, None if there is nothing to search.
+
+    Commas separate alternatives like the client's search box, the words of
+    an alternative must all match, each as a prefix. Words are quoted, so FTS5
+    syntax in the input is searched for literally.
+    """
+    alternatives = []
+    for term in query.split(","):
+        words = re.findall(r"\w+", term)
+        if words:
+            alternatives.append("(" + " ".join(f'"{word}"*' for word in words) + ")")
+
+    return " OR ".join(alternatives) or None
+
+
+def search_items(match, viewer_uuid=None, after=None, limit=20):
+    """Return (uuid, rank) of the best matches visible to ``viewer_uuid``.
+
+    Results are ordered by rank then uuid, ``after`` is the (rank, uuid)
+    of the last result of the previous page.
+    """
+    keyset = f"AND ({RANK}, item.uuid) > (:after_rank, :after_uuid)" if after else ""
+    rows = db.session.execute(
+        db.text(f"""
+            SELECT item.uuid, {RANK} AS rank
+            FROM marketplace_item_fts
+            JOIN marketplace_item AS item ON item.uuid = marketplace_item_fts.uuid
+            WHERE marketplace_item_fts MATCH :match
+            AND (item.is_private = 0 OR item.author_uuid = :viewer)
+            {keyset}
+            ORDER BY rank, item.uuid
+            LIMIT :limit
+            """),
+        {
+            "match": match,
+            "viewer": viewer_uuid,
+            "after_rank": after[0] if after else None,
+            "after_uuid": after[1] if after else None,
+            "limit": limit,
+        },
+    )
+    return rows.all()
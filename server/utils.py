@@ -1,3 +1,6 @@
+import base64
+import json
+from datetime import datetime
 from typing import List, Optional, Tuple, Union
 
 from config import Config
@@ -9,6 +12,55 @@ def unauthorized():
     return jsonify({"error": "Unauthorized", "message": "Please log in"}), 401
 
 
+def _encode_position(values: list) -> str:
+    payload = json.dumps(values).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def _decode_position(cursor: str) -> list:
+    payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    return json.loads(payload)
+
+
+def encode_cursor(created_at: datetime, uuid: str) -> str:
+    return _encode_position([created_at.isoformat(), uuid])
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, str]]:
+    """Return the (created_at, uuid) a cursor points after, None if it's invalid."""
+    try:
+        created_at, uuid = _decode_position(cursor)
+        return datetime.fromisoformat(created_at), str(uuid)
+    except (ValueError, TypeError):
+        return None
+
+
+def encode_popular_cursor(bookmark_count: int, created_at: datetime, uuid: str) -> str:
+    return _encode_position([bookmark_count, created_at.isoformat(), uuid])
+
+
+def decode_popular_cursor(cursor: str) -> Optional[Tuple[int, datetime, str]]:
+    """Return the (bookmark_count, created_at, uuid) a cursor points after."""
+    try:
+        bookmark_count, created_at, uuid = _decode_position(cursor)
+        return int(bookmark_count), datetime.fromisoformat(created_at), str(uuid)
+    except (ValueError, TypeError):
+        return None
+
+
+def encode_search_cursor(rank: float, item_uuid: str) -> str:
+    return _encode_position([rank, item_uuid])
+
+
+def decode_search_cursor(cursor: str) -> Optional[Tuple[float, str]]:
+    """Return the (rank, uuid) a search cursor points after, None if it's invalid."""
+    try:
+        rank, item_uuid = _decode_position(cursor)
+        return float(rank), str(item_uuid)
+    except (ValueError, TypeError):
+        return None
+
+
 def allowed_file(filename):
     return (
         "." in filename